@@ -0,0 +1,208 @@
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+
+import aiohttp
+
+from bookwyrm import db
+from bookwyrm.cogs.weather import params, utils
+from bookwyrm.cogs.weather.city import CityRepository
+from bookwyrm.cogs.weather.client import CurrentWeather, Forecast, WeatherClient
+from bookwyrm.cogs.weather.history import ObservationRecorder
+from bookwyrm.cogs.weather.providers import RecordingProvider, ReplayProvider
+from . import fakes
+from .harness import compare, format_table, load_report, make_report, run_benchmark
+
+
+async def run_all(args, workdir: str):
+    results = []
+    rng = random.Random(args.seed)
+
+    async def bench(name, func, iterations=args.iterations):
+        if args.filter and args.filter not in name:
+            return
+        result = await run_benchmark(name, func, iterations, warmup=args.warmup)
+        results.append(result)
+        print(f"{name}: {result.ops_per_sec:.1f} ops/s", file=sys.stderr)
+
+    # ---- cities ----
+    cities_path = os.path.join(workdir, 'cities.json')
+    fakes.write_cities(cities_path, args.cities, seed=args.seed)
+    cities = fakes.generate_cities(args.cities, seed=args.seed)
+    await bench(
+        'city_repository.reload_cities',
+        lambda: CityRepository.reload_cities(cities_path, city_filter=lambda c: c.country == 'US'),
+        iterations=max(args.iterations // 50, 3)
+    )
+    CityRepository.reload_cities(cities_path, city_filter=lambda c: c.country == 'US')
+
+    # ---- database ----
+    engine = await fakes.seed_database(
+        os.path.join(workdir, 'bookwyrm.db'), args.guilds, args.biomes, args.channels_per_biome, cities
+    )
+    n_biomes = args.guilds * args.biomes
+    n_channels = n_biomes * args.channels_per_biome
+
+    async def query_biome_by_id():
+        async with db.async_session() as session:
+            await utils.get_biome_by_id(session, rng.randint(1, n_biomes))
+
+    async def query_biomes_by_guild(load_channel_links):
+        async with db.async_session() as session:
+            await utils.get_biomes_by_guild(session, rng.randint(1, args.guilds), load_channel_links=load_channel_links)
+
+    async def query_channel_map():
+        async with db.async_session() as session:
+            await utils.get_channel_map_by_id(session, rng.randint(1, n_channels), load_biome=True)
+
+    await bench('db.get_biome_by_id', query_biome_by_id)
+    await bench('db.get_biomes_by_guild', lambda: query_biomes_by_guild(False))
+    await bench('db.get_biomes_by_guild+channels', lambda: query_biomes_by_guild(True))
+    await bench('db.get_channel_map_by_id+biome', query_channel_map)
+
+    # ---- history ----
+    recorder = ObservationRecorder()
+    history_cities = [c['id'] for c in cities[:20]]
+    base_dt = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=7)
+    history_samples = []
+    for city_id in history_cities:
+        payload = fakes.weather_payload(city_id)
+        for step in range(7 * 24):
+            payload['dt'] = int((base_dt + datetime.timedelta(hours=step)).timestamp())
+            history_samples.append((city_id, CurrentWeather.parse_obj(payload)))
+    # re-recorded rows hit ON CONFLICT DO NOTHING, which still costs a full batched write
+    history_iter = itertools.cycle(history_samples)
+
+    async def record_and_flush(batch=100):
+        for city_id, weather in itertools.islice(history_iter, batch):
+            recorder.record(city_id, weather)
+        await recorder.flush()
+
+    async def query_observations():
+        async with db.async_session() as session:
+            await utils.get_observations_since(
+                session, rng.choice(history_cities), datetime.datetime.utcnow() - datetime.timedelta(hours=24)
+            )
+
+    async def query_daily_range():
+        async with db.async_session() as session:
+            await utils.get_daily_temperature_range(
+                session, rng.choice(history_cities), datetime.datetime.utcnow() - datetime.timedelta(days=6)
+            )
+
+    await bench('history.record+flush', record_and_flush, iterations=max(args.iterations // 10, 3))
+    await recorder.flush()
+    await bench('db.get_observations_since', query_observations)
+    await bench('db.get_daily_temperature_range', query_daily_range)
+
+    # ---- autocomplete ----
+    queries = ['', 'a', 'spring', 'new york', 'san', 'xq']
+    await bench(
+        'params.city_autocomplete',
+        lambda: params.city_autocomplete(fakes.FakeInteraction(1), rng.choice(queries)),
+        iterations=max(args.iterations // 10, 3)
+    )
+    await bench(
+        'params.biome_autocomplete',
+        lambda: params.biome_autocomplete(fakes.FakeInteraction(rng.randint(1, args.guilds)), rng.choice(queries))
+    )
+
+    # ---- embeds ----
+    sample_weather = [CurrentWeather.parse_obj(fakes.weather_payload(c['id'])) for c in cities[:100]]
+    async with db.async_session() as session:
+        sample_biomes = await utils.get_biomes_by_guild(session, 1)
+    await bench(
+        'utils.weather_embed',
+        lambda: utils.weather_embed(rng.choice(sample_biomes), rng.choice(sample_weather))
+    )
+    sample_forecasts = [Forecast.parse_obj(fakes.forecast_payload(c['id'])) for c in cities[:20]]
+    await bench(
+        'utils.forecast_embed',
+        lambda: utils.forecast_embed(rng.choice(sample_biomes), rng.choice(sample_forecasts))
+    )
+
+    # ---- http ----
+    server = fakes.FakeWeatherServer(latency=args.http_latency)
+    await server.start()
+    try:
+        async with aiohttp.ClientSession() as http:
+            client = WeatherClient(http, 'benchmark')
+            client.SERVICE_BASE = server.base_url
+            await bench(
+                'weather_client.get_current_weather',
+                lambda: client.get_current_weather_by_city_id(rng.choice(cities)['id'])
+            )
+            await bench(
+                'weather_client.get_forecast',
+                lambda: client.get_forecast_by_city_id(rng.choice(cities)['id'])
+            )
+
+            # record a sample of real client responses, then replay them
+            recordings = os.path.join(workdir, 'recordings')
+            recorder = RecordingProvider(client, recordings)
+            for city in cities[:50]:
+                await recorder.get_current_weather_by_city_id(city['id'])
+                await recorder.get_forecast_by_city_id(city['id'])
+    finally:
+        await server.stop()
+        await engine.dispose()
+
+    replay = ReplayProvider(recordings, strict=False)
+    await bench(
+        'replay_provider.get_current_weather',
+        lambda: replay.get_current_weather_by_city_id(rng.choice(cities)['id'])
+    )
+    await bench(
+        'replay_provider.get_forecast',
+        lambda: replay.get_forecast_by_city_id(rng.choice(cities)['id'])
+    )
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description="Benchmarks the weather cog's hot paths against local stand-ins for Discord and OpenWeatherMap."
+    )
+    parser.add_argument('-n', '--iterations', type=int, default=500, help="Iterations per benchmark")
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cities', type=int, default=25000, help="Size of the generated city list")
+    parser.add_argument('--guilds', type=int, default=50)
+    parser.add_argument('--biomes', type=int, default=20, help="Biomes per guild")
+    parser.add_argument('--channels-per-biome', type=int, default=5)
+    parser.add_argument('--http-latency', type=float, default=0.0, help="Seconds the fake API waits per request")
+    parser.add_argument('-k', '--filter', help="Only run benchmarks whose name contains this string")
+    parser.add_argument('-o', '--output', help="Write the JSON report here instead of stdout")
+    parser.add_argument('--compare', metavar='BASELINE', help="A previous JSON report to check for regressions")
+    parser.add_argument('--threshold', type=float, default=0.1, help="Allowed latency growth vs. the baseline")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        results = asyncio.run(run_all(args, workdir))
+
+    report = make_report(results, **{k: v for k, v in vars(args).items() if k not in ('output', 'compare')})
+    print(format_table(results), file=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        regressions = compare(load_report(args.compare), report, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
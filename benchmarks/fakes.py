@@ -0,0 +1,297 @@
+import asyncio
+import itertools
+import json
+import multiprocessing
+import random
+import string
+import time
+import types
+from typing import List, Optional
+
+from aiohttp import web
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from bookwyrm import db, models
+
+US_STATES = [
+    'AL', 'AK', 'AZ', 'AR', 'CA', 'CO', 'CT', 'DE', 'FL', 'GA', 'HI', 'ID', 'IL', 'IN', 'IA', 'KS', 'KY', 'LA', 'ME',
+    'MD', 'MA', 'MI', 'MN', 'MS', 'MO', 'MT', 'NE', 'NV', 'NH', 'NJ', 'NM', 'NY', 'NC', 'ND', 'OH', 'OK', 'OR', 'PA',
+    'RI', 'SC', 'SD', 'TN', 'TX', 'UT', 'VT', 'VA', 'WA', 'WV', 'WI', 'WY'
+]
+WEATHER_CODES = [(200, 'Thunderstorm', '11d'), (301, 'Drizzle', '09d'), (501, 'Rain', '10d'), (601, 'Snow', '13d'),
+                 (741, 'Fog', '50d'), (800, 'Clear', '01d'), (803, 'Clouds', '04d')]
+
+
+# ==== cities ====
+def generate_cities(n: int, seed: int = 0) -> List[dict]:
+    """Generates a city list in the same shape as OpenWeatherMap's city.list.min.json."""
+    rng = random.Random(seed)
+    cities = []
+    for i in range(n):
+        name = ''.join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 12))).title()
+        cities.append({
+            'id': 1000000 + i,
+            'name': name,
+            'state': rng.choice(US_STATES),
+            'country': 'US' if rng.random() < 0.8 else 'CA',
+            'coord': {'lat': rng.uniform(-90, 90), 'lon': rng.uniform(-180, 180)}
+        })
+    return cities
+
+
+def write_cities(path: str, n: int, seed: int = 0):
+    with open(path, 'w') as f:
+        json.dump(generate_cities(n, seed), f)
+
+
+# ==== openweathermap ====
+def weather_payload(city_id: int) -> dict:
+    """A deterministic /weather response for the given city."""
+    rng = random.Random(city_id)
+    now = int(time.time())
+    code, main, icon = rng.choice(WEATHER_CODES)
+    temp = rng.uniform(250, 310)
+    return {
+        'coord': {'lat': rng.uniform(-90, 90), 'lon': rng.uniform(-180, 180)},
+        'weather': [{'id': code, 'main': main, 'description': main.lower(), 'icon': icon}],
+        'base': 'stations',
+        'main': {
+            'temp': temp,
+            'pressure': rng.randint(980, 1040),
+            'humidity': rng.randint(0, 100),
+            'temp_min': temp - rng.uniform(0, 5),
+            'temp_max': temp + rng.uniform(0, 5)
+        },
+        'visibility': rng.randint(100, 10000),
+        'wind': {'speed': rng.uniform(0, 15), 'deg': rng.randint(0, 359)},
+        'clouds': {'all': rng.randint(0, 100)},
+        'dt': now,
+        'sys': {'country': 'US', 'sunrise': now - 21600, 'sunset': now + 21600, 'type': 1, 'id': 1},
+        'id': city_id,
+        'name': f"City {city_id}",
+        'cod': 200
+    }
+
+
+def forecast_payload(city_id: int) -> dict:
+    """A deterministic /forecast response (5 days in 3 hour steps) for the given city."""
+    rng = random.Random(city_id)
+    start = int(time.time()) // 10800 * 10800
+    entries = []
+    for i in range(40):
+        current = weather_payload(city_id + i)
+        entries.append({
+            'dt': start + i * 10800,
+            'main': current['main'],
+            'weather': current['weather'],
+            'clouds': current['clouds'],
+            'wind': current['wind'],
+            'visibility': current['visibility'],
+            'pop': rng.random()
+        })
+    return {
+        'cod': '200',
+        'message': 0,
+        'cnt': len(entries),
+        'list': entries,
+        'city': {
+            'id': city_id,
+            'name': f"City {city_id}",
+            'coord': {'lat': rng.uniform(-90, 90), 'lon': rng.uniform(-180, 180)},
+            'country': 'US',
+            'timezone': rng.choice([-28800, -25200, -21600, -18000]),
+            'sunrise': start - 21600,
+            'sunset': start + 21600
+        }
+    }
+
+
+class FakeWeatherServer:
+    """
+    A local HTTP server that answers the subset of the OpenWeatherMap API that WeatherClient uses.
+
+    Each request waits *latency* seconds, plus up to *jitter* more, and fails with a 500 (or a 429, if
+    *rate_limit_errors* is set) with probability *error_rate*.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        rate_limit_errors: bool = False,
+        host: str = '127.0.0.1',
+        seed: int = 0
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_errors = rate_limit_errors
+        self.host = host
+        self.requests = 0
+        self.errors = 0
+        self.injected_delay = 0.0  # total seconds spent sleeping on purpose
+        self._rng = random.Random(seed)
+        self._runner: Optional[web.AppRunner] = None
+        self.base_url: Optional[str] = None
+
+    async def _handle_weather(self, request: web.Request) -> web.Response:
+        return await self._respond(weather_payload(int(request.query['id'])))
+
+    async def _handle_forecast(self, request: web.Request) -> web.Response:
+        return await self._respond(forecast_payload(int(request.query['id'])))
+
+    async def _respond(self, payload: dict) -> web.Response:
+        self.requests += 1
+        delay = self.latency + self._rng.uniform(0, self.jitter)
+        if delay:
+            self.injected_delay += delay
+            await asyncio.sleep(delay)
+        if self.error_rate and self._rng.random() < self.error_rate:
+            self.errors += 1
+            if self.rate_limit_errors:
+                return web.json_response({'cod': 429, 'message': "Too many requests"}, status=429)
+            return web.json_response({'cod': 500, 'message': "Internal error"}, status=500)
+        return web.json_response(payload)
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_get('/data/2.5/weather', self._handle_weather)
+        app.router.add_get('/data/2.5/forecast', self._handle_forecast)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{self.host}:{port}/data/2.5"
+        return self.base_url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+def _serve_in_process(kwargs: dict, conn):
+    async def main():
+        server = FakeWeatherServer(**kwargs)
+        conn.send(await server.start())
+        loop = asyncio.get_running_loop()
+        while True:
+            command = await loop.run_in_executor(None, conn.recv)
+            conn.send({'requests': server.requests, 'errors': server.errors, 'injected_delay': server.injected_delay})
+            if command == 'stop':
+                await server.stop()
+                return
+
+    asyncio.run(main())
+
+
+class FakeWeatherServerProcess:
+    """
+    Runs a FakeWeatherServer (taking the same arguments) in a child process, so that serving the mock API doesn't
+    count towards the CPU time and event loop lag of the code under test. The request counters are refreshed by
+    refresh() and stop().
+    """
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.base_url: Optional[str] = None
+        self.requests = 0
+        self.errors = 0
+        self.injected_delay = 0.0
+        self._conn = None
+        self._process: Optional[multiprocessing.Process] = None
+
+    async def start(self) -> str:
+        # spawn rather than fork: a forked child would inherit the parent's running event loop
+        ctx = multiprocessing.get_context('spawn')
+        self._conn, child_conn = ctx.Pipe()
+        self._process = ctx.Process(target=_serve_in_process, args=(self.kwargs, child_conn), daemon=True)
+        self._process.start()
+        self.base_url = await asyncio.get_running_loop().run_in_executor(None, self._conn.recv)
+        return self.base_url
+
+    async def _command(self, command: str):
+        self._conn.send(command)
+        stats = await asyncio.get_running_loop().run_in_executor(None, self._conn.recv)
+        self.requests = stats['requests']
+        self.errors = stats['errors']
+        self.injected_delay = stats['injected_delay']
+
+    async def refresh(self):
+        await self._command('stats')
+
+    async def stop(self):
+        if self._process is not None:
+            await self._command('stop')
+            self._process.join()
+            self._process = None
+
+
+# ==== discord ====
+_interaction_ids = itertools.count(1)
+
+
+class FakeResponse:
+    def __init__(self, inter: 'FakeInteraction'):
+        self.inter = inter
+        self.deferred = False
+
+    async def defer(self, **_):
+        self.deferred = True
+        self.inter.mark_responded()
+
+
+class FakeInteraction:
+    """Quacks enough like a disnake.ApplicationCommandInteraction to drive autocompleters and cog callbacks."""
+
+    def __init__(self, guild_id: int, channel_id: int = 0, guild_name: str = "Benchmark Guild"):
+        self.id = next(_interaction_ids)
+        self.guild_id = guild_id
+        self.guild = types.SimpleNamespace(id=guild_id, name=guild_name)
+        self.channel_id = channel_id
+        self.channel = types.SimpleNamespace(id=channel_id)
+        self.response = FakeResponse(self)
+        self.sent = []
+        self.created_at = time.perf_counter()
+        self.responded_at: Optional[float] = None
+
+    def mark_responded(self):
+        if self.responded_at is None:
+            self.responded_at = time.perf_counter()
+
+    @property
+    def response_time(self) -> Optional[float]:
+        """Seconds between the interaction being created and its initial response (a message or a defer)."""
+        if self.responded_at is None:
+            return None
+        return self.responded_at - self.created_at
+
+    async def send(self, content=None, **kwargs):
+        self.mark_responded()
+        self.sent.append((content, kwargs))
+
+
+# ==== database ====
+async def seed_database(path: str, guilds: int, biomes_per_guild: int, channels_per_biome: int, cities: List[dict]):
+    """
+    Creates a fresh SQLite database at *path*, fills it with biomes and channel links, and points
+    ``bookwyrm.db.async_session`` at it. Returns the engine.
+    """
+    engine = create_async_engine(f'sqlite+aiosqlite:///{path}', echo=False)
+    async with engine.begin() as conn:
+        await conn.run_sync(db.Base.metadata.drop_all)
+        await conn.run_sync(db.Base.metadata.create_all)
+    db.instrument(engine)
+    db.async_session.configure(bind=engine)
+
+    rng = random.Random(0)
+    channel_ids = itertools.count(1)
+    async with db.async_session() as session:
+        for guild_id in range(1, guilds + 1):
+            for b in range(biomes_per_guild):
+                biome = models.Biome(guild_id=guild_id, name=f"Biome {guild_id}-{b}", city_id=rng.choice(cities)['id'])
+                biome.channels = [models.ChannelMap(channel_id=next(channel_ids)) for _ in range(channels_per_biome)]
+                session.add(biome)
+        await session.commit()
+    return engine
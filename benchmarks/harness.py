@@ -0,0 +1,132 @@
+import dataclasses
+import inspect
+import json
+import math
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Awaitable, Callable, Dict, List, Optional, Union
+
+BenchmarkFunc = Callable[[], Union[Awaitable, object]]
+
+
+@dataclasses.dataclass
+class BenchmarkResult:
+    name: str
+    iterations: int
+    total_s: float
+    ops_per_sec: float
+    mean_ms: float
+    p50_ms: float
+    p99_ms: float
+    peak_mem_kib: float
+
+
+def percentile(samples: List[float], q: float) -> float:
+    """Nearest-rank percentile of an unsorted list of samples."""
+    ordered = sorted(samples)
+    idx = max(math.ceil(q * len(ordered)) - 1, 0)
+    return ordered[idx]
+
+
+async def _call(func: BenchmarkFunc):
+    result = func()
+    if inspect.isawaitable(result):
+        await result
+
+
+async def run_benchmark(
+    name: str,
+    func: BenchmarkFunc,
+    iterations: int,
+    warmup: int = 5,
+    memory_iterations: int = 10
+) -> BenchmarkResult:
+    """
+    Runs *func* *iterations* times and records the latency of each call. Peak memory is measured in a separate,
+    shorter pass since tracemalloc adds significant overhead to every allocation.
+    """
+    for _ in range(warmup):
+        await _call(func)
+
+    samples = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        call_start = time.perf_counter()
+        await _call(func)
+        samples.append(time.perf_counter() - call_start)
+    total = time.perf_counter() - start
+
+    tracemalloc.start()
+    try:
+        for _ in range(min(memory_iterations, iterations)):
+            await _call(func)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return BenchmarkResult(
+        name=name,
+        iterations=iterations,
+        total_s=total,
+        ops_per_sec=iterations / total if total else float('inf'),
+        mean_ms=sum(samples) / len(samples) * 1000,
+        p50_ms=percentile(samples, 0.5) * 1000,
+        p99_ms=percentile(samples, 0.99) * 1000,
+        peak_mem_kib=peak / 1024
+    )
+
+
+# ==== reporting ====
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_meta(**params) -> dict:
+    return {
+        'timestamp': time.time(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'revision': _git_revision(),
+        'params': params
+    }
+
+
+def make_report(results: List[BenchmarkResult], **params) -> dict:
+    return {'meta': make_meta(**params), 'results': [dataclasses.asdict(r) for r in results]}
+
+
+def format_table(results: List[BenchmarkResult]) -> str:
+    out = [f"{'benchmark':<36} {'ops/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'peak KiB':>10}"]
+    for r in results:
+        out.append(f"{r.name:<36} {r.ops_per_sec:>10.1f} {r.p50_ms:>9.3f} {r.p99_ms:>9.3f} {r.peak_mem_kib:>10.1f}")
+    return '\n'.join(out)
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> List[str]:
+    """
+    Compares two reports and returns a list of regressions: benchmarks whose p50 or p99 latency grew by more than
+    *threshold* (a fraction, e.g. 0.1 for 10%).
+    """
+    baseline_results: Dict[str, dict] = {r['name']: r for r in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        old = baseline_results.get(result['name'])
+        if old is None:
+            continue
+        for key in ('p50_ms', 'p99_ms'):
+            if old[key] and (result[key] - old[key]) / old[key] > threshold:
+                regressions.append(f"{result['name']}: {key} {old[key]:.3f} -> {result[key]:.3f}")
+    return regressions
+
+
+def load_report(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
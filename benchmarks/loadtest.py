@@ -0,0 +1,295 @@
+import argparse
+import asyncio
+import dataclasses
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+from typing import Dict, List, Optional
+
+from bookwyrm.cogs.weather import Weather, params
+from bookwyrm.cogs.weather.city import CityRepository
+from bookwyrm.cogs.weather.client import WeatherClient
+from bookwyrm.cogs.weather.providers import ReplayProvider
+from bookwyrm.utils import metrics
+from . import fakes
+from .harness import make_meta, percentile
+
+INTERACTION_DEADLINE = 3.0  # seconds discord gives us to send an initial response
+
+
+@dataclasses.dataclass
+class LevelResult:
+    concurrency: int
+    interactions: int
+    throughput: float
+    errors: int
+    error_rate: float
+    deadline_misses: int
+    deadline_miss_rate: float
+    p50_ms: float
+    p99_ms: float
+    cpu_utilization: float
+    loop_lag_p99_ms: float
+    http_ms_per_interaction: float
+    upstream_ms_per_interaction: float
+    db_ms_per_interaction: float
+    bottleneck: str
+    by_kind: Dict[str, dict]
+
+
+def _histogram_totals(histogram: metrics.Histogram):
+    """Returns (sum, count) across all label values of a histogram."""
+    total = count = 0
+    for _, value_sum, value_count in histogram.values.values():
+        total += value_sum
+        count += value_count
+    return total, count
+
+
+def _classify_bottleneck(cpu_utilization: float, loop_lag_p99: float, http_time: float, db_time: float) -> str:
+    # a busy event loop delays everything, so CPU wins whenever the loop can't keep up. http_time should exclude the
+    # upstream API's own latency, which stays the same no matter how loaded the bot is
+    if cpu_utilization > 0.8 or loop_lag_p99 > 0.1:
+        return 'cpu'
+    return 'http' if http_time >= db_time else 'db'
+
+
+class LoadGenerator:
+    def __init__(self, cog: Weather, args, server: fakes.FakeWeatherServerProcess):
+        self.cog = cog
+        self.args = args
+        self.server = server
+        self.rng = random.Random(args.seed)
+        self.n_biomes = args.guilds * args.biomes
+        self.kinds = {
+            'weather_channel': args.weight_weather_channel,
+            'weather_biome': args.weight_weather_biome,
+            'summary': args.weight_summary,
+            'biome_autocomplete': args.weight_biome_autocomplete,
+            'city_autocomplete': args.weight_city_autocomplete
+        }
+
+    def _guild_for_biome(self, biome_id: int) -> int:
+        # seed_database creates biomes guild by guild, so biome IDs map back to their guild
+        return (biome_id - 1) // self.args.biomes + 1
+
+    async def run_one(self, kind: str) -> fakes.FakeInteraction:
+        args = self.args
+        biome_id = self.rng.randint(1, self.n_biomes)
+        guild_id = self._guild_for_biome(biome_id)
+        if kind == 'weather_channel':
+            channel_id = (biome_id - 1) * args.channels_per_biome + 1
+            inter = fakes.FakeInteraction(guild_id, channel_id=channel_id)
+            await self.cog.weather.callback(self.cog, inter, biome=None)
+        elif kind == 'weather_biome':
+            inter = fakes.FakeInteraction(guild_id)
+            biome = await params.biome_converter(inter, f"Biome - {biome_id}")
+            await self.cog.weather.callback(self.cog, inter, biome=biome)
+        elif kind == 'summary':
+            inter = fakes.FakeInteraction(guild_id)
+            await self.cog.summary.callback(self.cog, inter)
+        elif kind == 'biome_autocomplete':
+            inter = fakes.FakeInteraction(guild_id)
+            await params.biome_autocomplete(inter, self.rng.choice(['', 'biome', '1-', 'xq']))
+            inter.mark_responded()
+        else:
+            inter = fakes.FakeInteraction(guild_id)
+            await params.city_autocomplete(inter, self.rng.choice(['', 'spring', 'san', 'xq']))
+            inter.mark_responded()
+        return inter
+
+    async def run_level(self, concurrency: int) -> LevelResult:
+        """Runs *concurrency* closed-loop workers for the configured duration and summarizes the results."""
+        samples: Dict[str, List[Optional[float]]] = {kind: [] for kind in self.kinds}
+        errors = 0
+        lags = []
+        stop_at = time.perf_counter() + self.args.duration
+        kinds, weights = zip(*self.kinds.items())
+
+        async def worker():
+            nonlocal errors
+            while time.perf_counter() < stop_at:
+                kind = self.rng.choices(kinds, weights)[0]
+                try:
+                    inter = await self.run_one(kind)
+                except Exception:
+                    # the bot would still answer with an error message, but the user didn't get their weather
+                    errors += 1
+                    samples[kind].append(None)
+                else:
+                    samples[kind].append(inter.response_time)
+
+        async def lag_monitor(interval=0.01):
+            while True:
+                start = time.perf_counter()
+                await asyncio.sleep(interval)
+                lags.append(max(time.perf_counter() - start - interval, 0))
+
+        await self.server.refresh()
+        upstream_before = self.server.injected_delay
+        http_before = _histogram_totals(metrics.HTTP_REQUEST_LATENCY)[0]
+        db_before = _histogram_totals(metrics.DB_QUERY_LATENCY)[0]
+        cpu_before = time.process_time()
+        wall_before = time.perf_counter()
+
+        lag_task = asyncio.create_task(lag_monitor())
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        lag_task.cancel()
+
+        wall = time.perf_counter() - wall_before
+        cpu_utilization = (time.process_time() - cpu_before) / wall
+        http_time = _histogram_totals(metrics.HTTP_REQUEST_LATENCY)[0] - http_before
+        db_time = _histogram_totals(metrics.DB_QUERY_LATENCY)[0] - db_before
+        await self.server.refresh()
+        upstream_time = self.server.injected_delay - upstream_before
+        # what's left is time spent queueing for connections and handling responses on our side
+        client_http_time = max(http_time - upstream_time, 0.0)
+
+        all_samples = [s for kind_samples in samples.values() for s in kind_samples]
+        answered = [s for s in all_samples if s is not None]
+        # injected upstream errors are reported separately; a miss is a response that came too late
+        misses = sum(1 for s in answered if s > INTERACTION_DEADLINE)
+        n = len(all_samples)
+        loop_lag_p99 = percentile(lags, 0.99) if lags else 0.0
+
+        by_kind = {}
+        for kind, kind_samples in samples.items():
+            kind_answered = [s for s in kind_samples if s is not None]
+            by_kind[kind] = {
+                'interactions': len(kind_samples),
+                'errors': len(kind_samples) - len(kind_answered),
+                'p99_ms': percentile(kind_answered, 0.99) * 1000 if kind_answered else None
+            }
+
+        return LevelResult(
+            concurrency=concurrency,
+            interactions=n,
+            throughput=n / wall,
+            errors=errors,
+            error_rate=errors / n if n else 0.0,
+            deadline_misses=misses,
+            deadline_miss_rate=misses / n if n else 0.0,
+            p50_ms=percentile(answered, 0.5) * 1000 if answered else 0.0,
+            p99_ms=percentile(answered, 0.99) * 1000 if answered else 0.0,
+            cpu_utilization=cpu_utilization,
+            loop_lag_p99_ms=loop_lag_p99 * 1000,
+            http_ms_per_interaction=http_time / n * 1000 if n else 0.0,
+            upstream_ms_per_interaction=upstream_time / n * 1000 if n else 0.0,
+            db_ms_per_interaction=db_time / n * 1000 if n else 0.0,
+            bottleneck=_classify_bottleneck(cpu_utilization, loop_lag_p99, client_http_time, db_time),
+            by_kind=by_kind
+        )
+
+
+async def run_load_test(args, workdir: str):
+    cities = fakes.generate_cities(args.cities, seed=args.seed)
+    cities_path = os.path.join(workdir, 'cities.json')
+    fakes.write_cities(cities_path, args.cities, seed=args.seed)
+    CityRepository.reload_cities(cities_path, city_filter=lambda c: c.country == 'US')
+    engine = await fakes.seed_database(
+        os.path.join(workdir, 'bookwyrm.db'), args.guilds, args.biomes, args.channels_per_biome, cities
+    )
+
+    server = fakes.FakeWeatherServerProcess(
+        latency=args.http_latency,
+        jitter=args.http_jitter,
+        error_rate=args.error_rate,
+        rate_limit_errors=args.rate_limit_errors,
+        seed=args.seed
+    )
+    await server.start()
+    cog = Weather(types.SimpleNamespace(loop=asyncio.get_running_loop()))
+    # replace whatever provider the environment configured
+    if args.replay:
+        # takes the upstream API out of the picture, so the bot's own overhead is what saturates
+        provider = ReplayProvider(args.replay, strict=False)
+    else:
+        provider = WeatherClient(cog.http, 'loadtest')
+        provider.SERVICE_BASE = server.base_url
+    cog.client = cog.scheduler.client = provider
+    generator = LoadGenerator(cog, args, server)
+
+    levels = []
+    saturation = None
+    try:
+        concurrency = args.start
+        while concurrency <= args.max_concurrency:
+            result = await generator.run_level(concurrency)
+            levels.append(result)
+            print(
+                f"concurrency={concurrency}: {result.throughput:.1f}/s, p99 {result.p99_ms:.0f}ms, "
+                f"misses {result.deadline_miss_rate:.1%}, bottleneck {result.bottleneck}",
+                file=sys.stderr
+            )
+            if result.deadline_miss_rate > args.max_miss_rate:
+                saturation = result
+                break
+            concurrency *= 2
+    finally:
+        await cog.http.close()
+        await server.stop()
+        await engine.dispose()
+
+    sustained = [level for level in levels if level.deadline_miss_rate <= args.max_miss_rate]
+    return {
+        'saturated': saturation is not None,
+        'saturation_concurrency': saturation.concurrency if saturation else None,
+        'max_sustained_concurrency': sustained[-1].concurrency if sustained else None,
+        'max_sustained_throughput': max((level.throughput for level in sustained), default=None),
+        'bottleneck': (saturation or levels[-1]).bottleneck if levels else None,
+        'upstream_requests': server.requests,
+        'upstream_errors': server.errors,
+        'levels': [dataclasses.asdict(level) for level in levels]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.loadtest',
+        description="Ramps up concurrent /weather, /summary and autocomplete interactions against the weather cog "
+                    "until the interaction deadline starts being missed."
+    )
+    parser.add_argument('--start', type=int, default=1, help="Initial concurrency; doubles every level")
+    parser.add_argument('--max-concurrency', type=int, default=1024)
+    parser.add_argument('--duration', type=float, default=5.0, help="Seconds to run each level")
+    parser.add_argument('--max-miss-rate', type=float, default=0.01, help="Deadline miss rate considered saturated")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cities', type=int, default=25000)
+    parser.add_argument('--guilds', type=int, default=200)
+    parser.add_argument('--biomes', type=int, default=10, help="Biomes per guild")
+    parser.add_argument('--channels-per-biome', type=int, default=3)
+    parser.add_argument('--http-latency', type=float, default=0.1, help="Base seconds the mock API waits")
+    parser.add_argument('--http-jitter', type=float, default=0.1, help="Extra random seconds the mock API waits")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of mock API requests that fail")
+    parser.add_argument('--rate-limit-errors', action='store_true', help="Inject 429s instead of 500s")
+    parser.add_argument(
+        '--replay', metavar='DIR', help="Serve the weather from responses recorded in DIR instead of the mock API"
+    )
+    parser.add_argument('--weight-weather-channel', type=float, default=5)
+    parser.add_argument('--weight-weather-biome', type=float, default=2)
+    parser.add_argument('--weight-summary', type=float, default=1)
+    parser.add_argument('--weight-biome-autocomplete', type=float, default=3)
+    parser.add_argument('--weight-city-autocomplete', type=float, default=1)
+    parser.add_argument('-o', '--output', help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    # injected upstream errors would otherwise log a warning each
+    logging.basicConfig(level=logging.ERROR)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        result = asyncio.run(run_load_test(args, workdir))
+
+    report = {'meta': make_meta(**{k: v for k, v in vars(args).items() if k != 'output'}), **result}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
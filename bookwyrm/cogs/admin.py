@@ -3,8 +3,11 @@ import textwrap
 import traceback
 from contextlib import redirect_stdout
 
+import disnake
 from disnake.ext import commands
 
+from bookwyrm.utils import metrics
+
 ADMIN_IDS = [
     187421759484592128,
     197519973650923520
@@ -68,6 +71,18 @@ class Admin(commands.Cog):
             else:
                 await ctx.send('```py\n{}{}\n```'.format(value, ret))
 
+    @commands.command(hidden=True, name='metrics')
+    async def _metrics(self, ctx):
+        """Dumps a snapshot of the bot's metrics"""
+        if ctx.author.id not in ADMIN_IDS:
+            return
+
+        snapshot = metrics.REGISTRY.snapshot()
+        if len(snapshot) < 1990:
+            await ctx.send('```\n{}\n```'.format(snapshot))
+        else:
+            await ctx.send(file=disnake.File(io.BytesIO(snapshot.encode()), filename='metrics.txt'))
+
 
 def setup(bot):
     bot.add_cog(Admin(bot))
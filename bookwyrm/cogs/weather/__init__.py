@@ -6,3 +6,5 @@ def setup(bot):
     CityRepository.reload_cities(city_filter=lambda c: c.country == 'US')
     weather = Weather(bot)
     bot.add_cog(weather)
+    weather.scheduler.start()
+    weather.observations.start(bot.loop)
@@ -0,0 +1,189 @@
+import csv
+import io
+import json
+from typing import Dict, Iterable, List, Optional
+
+from pydantic import BaseModel, ValidationError
+from sqlalchemy import bindparam, insert, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from bookwyrm import models
+from .city import CityRepository
+
+CSV_FIELDS = ('name', 'city_id', 'image_url', 'channel_id')
+
+
+# ==== models ====
+class BiomeSpec(BaseModel):
+    name: str
+    city_id: int
+    image_url: Optional[str] = None
+    channels: List[int] = []
+
+
+class BulkResult(BaseModel):
+    biomes_created: int = 0
+    biomes_updated: int = 0
+    channels_linked: int = 0
+
+
+# ==== import/export formats ====
+def parse_biome_file(data: bytes, filename: str) -> List[BiomeSpec]:
+    """
+    Parses a JSON or CSV biome export. JSON is a list of biomes (or ``{"biomes": [...]}``); CSV has one row per
+    channel link with the columns ``name,city_id,image_url,channel_id``, where a biome with no channels has one row
+    with an empty ``channel_id``. Raises a ValueError if the file is malformed.
+    """
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError as e:
+        raise ValueError("The file must be UTF-8 encoded") from e
+
+    if filename.lower().endswith('.csv'):
+        return _parse_csv(text)
+    try:
+        raw = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Invalid JSON: {e}") from e
+    if isinstance(raw, dict):
+        raw = raw.get('biomes', [])
+    if not isinstance(raw, list):
+        raise ValueError("Expected a list of biomes")
+    try:
+        return [BiomeSpec.parse_obj(b) for b in raw]
+    except ValidationError as e:
+        raise ValueError(f"Invalid biome: {e}") from e
+
+
+def _parse_csv(text: str) -> List[BiomeSpec]:
+    specs: Dict[str, BiomeSpec] = {}
+    reader = csv.DictReader(io.StringIO(text))
+    if reader.fieldnames is None or not {'name', 'city_id'}.issubset(reader.fieldnames):
+        raise ValueError("CSV files must have at least the columns name and city_id")
+    for line_no, row in enumerate(reader, start=2):
+        try:
+            spec = specs.get(row['name'])
+            if spec is None:
+                spec = specs[row['name']] = BiomeSpec(name=row['name'], city_id=row['city_id'])
+                # without the column, existing images are left alone; an empty cell removes the image
+                if 'image_url' in row:
+                    spec.image_url = row['image_url'] or None
+            if row.get('channel_id'):
+                spec.channels.append(int(row['channel_id']))
+        except (ValidationError, ValueError) as e:
+            raise ValueError(f"Invalid row on line {line_no}: {e}") from e
+    return list(specs.values())
+
+
+def export_biomes_json(biomes: Iterable[models.Biome]) -> str:
+    out = [
+        BiomeSpec(
+            name=b.name, city_id=b.city_id, image_url=b.image_url, channels=[c.channel_id for c in b.channels]
+        ).dict()
+        for b in biomes
+    ]
+    return json.dumps({'biomes': out}, indent=2)
+
+
+def export_biomes_csv(biomes: Iterable[models.Biome]) -> str:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(CSV_FIELDS)
+    for b in biomes:
+        if not b.channels:
+            writer.writerow((b.name, b.city_id, b.image_url or '', ''))
+        for channel_link in b.channels:
+            writer.writerow((b.name, b.city_id, b.image_url or '', channel_link.channel_id))
+    return buf.getvalue()
+
+
+# ==== service ====
+def validate_specs(specs: List[BiomeSpec]):
+    """
+    Raises a ValueError if any spec references a city that doesn't exist, repeats a biome name, or links a channel
+    twice.
+    """
+    seen_names = set()
+    seen_channels = set()
+    for spec in specs:
+        if spec.name in seen_names:
+            raise ValueError(f"The biome {spec.name!r} appears more than once")
+        seen_names.add(spec.name)
+        if CityRepository.get_city(spec.city_id) is None:
+            raise ValueError(f"The city {spec.city_id} for biome {spec.name!r} doesn't exist")
+        for channel_id in spec.channels:
+            if channel_id in seen_channels:
+                raise ValueError(f"The channel {channel_id} is linked to more than one biome")
+            seen_channels.add(channel_id)
+
+
+async def upsert_biomes(session, guild_id: int, specs: List[BiomeSpec]) -> BulkResult:
+    """
+    Creates or updates the given biomes in a guild, matching existing biomes by name, and links their channels.
+    An existing biome's image is only changed if the spec sets ``image_url``. Does not commit; callers should commit
+    once to apply everything in one transaction.
+    """
+    result = BulkResult()
+    biome_table = models.Biome.__table__
+    existing = await _biome_ids_by_name(session, guild_id)
+
+    to_insert = [
+        {'guild_id': guild_id, 'name': s.name, 'city_id': s.city_id, 'image_url': s.image_url}
+        for s in specs if s.name not in existing
+    ]
+    # executemany needs the same columns in every row, so updates that keep the image go in a second statement
+    to_update_with_image = []
+    to_update_city_only = []
+    for s in specs:
+        if s.name not in existing:
+            continue
+        if 'image_url' in s.__fields_set__:
+            to_update_with_image.append({'b_id': existing[s.name], 'b_city_id': s.city_id, 'b_image_url': s.image_url})
+        else:
+            to_update_city_only.append({'b_id': existing[s.name], 'b_city_id': s.city_id})
+    if to_insert:
+        await session.execute(insert(biome_table), to_insert)
+        result.biomes_created = len(to_insert)
+    update_stmt = update(biome_table).where(biome_table.c.id == bindparam('b_id'))
+    if to_update_with_image:
+        await session.execute(
+            update_stmt.values(city_id=bindparam('b_city_id'), image_url=bindparam('b_image_url')),
+            to_update_with_image
+        )
+    if to_update_city_only:
+        await session.execute(update_stmt.values(city_id=bindparam('b_city_id')), to_update_city_only)
+    result.biomes_updated = len(to_update_with_image) + len(to_update_city_only)
+
+    # we need the IDs of the newly inserted biomes to link channels to them
+    if to_insert:
+        existing = await _biome_ids_by_name(session, guild_id)
+    links = {channel_id: existing[s.name] for s in specs for channel_id in s.channels}
+    result.channels_linked = await link_channels(session, links)
+    return result
+
+
+async def link_channels(session, links: Dict[int, int]) -> int:
+    """Links each channel ID to a biome ID, replacing any existing link, in one statement. Does not commit."""
+    if not links:
+        return 0
+    stmt = sqlite_insert(models.ChannelMap.__table__)
+    stmt = stmt.on_conflict_do_update(index_elements=['channel_id'], set_={'biome_id': stmt.excluded.biome_id})
+    await session.execute(stmt, [{'channel_id': c, 'biome_id': b} for c, b in links.items()])
+    return len(links)
+
+
+async def clone_biomes(session, source_guild_id: int, dest_guild_id: int) -> BulkResult:
+    """
+    Copies every biome in the source guild to the destination guild, updating biomes with the same name. Channel
+    links are not copied, since channels belong to a single guild. Does not commit.
+    """
+    result = await session.execute(select(models.Biome).where(models.Biome.guild_id == source_guild_id))
+    specs = [BiomeSpec(name=b.name, city_id=b.city_id, image_url=b.image_url) for b in result.scalars()]
+    return await upsert_biomes(session, dest_guild_id, specs)
+
+
+async def _biome_ids_by_name(session, guild_id: int) -> Dict[str, int]:
+    result = await session.execute(
+        select(models.Biome.name, models.Biome.id).where(models.Biome.guild_id == guild_id)
+    )
+    return {name: biome_id for name, biome_id in result}
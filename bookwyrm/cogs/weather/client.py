@@ -1,14 +1,17 @@
+import abc
 import datetime
 from typing import Any, Dict, List, Optional
 
 import aiohttp
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 from bookwyrm.utils.httpclient import BaseClient
 from .city import LatLon
 
 
 # ==== response models ====
+# These follow OpenWeatherMap's responses, and are also the common format every WeatherProvider returns. Fields that
+# only OpenWeatherMap knows about are optional.
 class _WeatherDetail(BaseModel):
     id: int
     main: str
@@ -41,16 +44,46 @@ class _WeatherSystemInfo(BaseModel):
 class CurrentWeather(BaseModel):
     coord: LatLon
     weather: List[_WeatherDetail]
-    base: str
+    base: Optional[str]
     main: _WeatherMain
     visibility: int
     wind: _WeatherWind
-    clouds: Dict[str, int]
+    clouds: Dict[str, int] = {}
     dt: datetime.datetime
-    sys: _WeatherSystemInfo
+    sys: Optional[_WeatherSystemInfo]
     id: int
     name: str
-    cod: int
+    cod: Optional[int]
+
+
+class _ForecastEntry(BaseModel):
+    dt: datetime.datetime
+    main: _WeatherMain
+    weather: List[_WeatherDetail]
+    clouds: Dict[str, int] = {}
+    wind: _WeatherWind
+    visibility: Optional[int]
+    pop: float = 0  # probability of precipitation
+
+
+class _ForecastCity(BaseModel):
+    id: int
+    name: str
+    coord: LatLon
+    country: str
+    timezone: int  # UTC offset in seconds
+    sunrise: Optional[datetime.datetime]
+    sunset: Optional[datetime.datetime]
+
+
+class Forecast(BaseModel):
+    """5 day forecast in 3 hour steps"""
+    cnt: int
+    entries: List[_ForecastEntry] = Field(alias='list')
+    city: _ForecastCity
+
+    class Config:
+        allow_population_by_field_name = True
 
 
 # ==== weather codes ====
@@ -118,9 +151,24 @@ WEATHER_DESC = {
 }
 
 
-# ==== client ===
-class WeatherClient(BaseClient):
+# ==== providers ====
+class WeatherProvider(abc.ABC):
+    """A source of weather data. See providers.py for the other implementations."""
+    name: str = ...
+
+    @abc.abstractmethod
+    async def get_current_weather_by_city_id(self, city_id: int) -> CurrentWeather:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_forecast_by_city_id(self, city_id: int) -> Forecast:
+        raise NotImplementedError
+
+
+class WeatherClient(BaseClient, WeatherProvider):
+    """OpenWeatherMap"""
     SERVICE_BASE = "https://api.openweathermap.org/data/2.5"
+    name = 'openweathermap'
 
     def __init__(self, http: aiohttp.ClientSession, api_key: str):
         super().__init__(http)
@@ -129,3 +177,7 @@ class WeatherClient(BaseClient):
     async def get_current_weather_by_city_id(self, city_id: int) -> CurrentWeather:
         data = await self.get("/weather", params={"id": city_id, "appid": self.api_key})
         return CurrentWeather.parse_obj(data)
+
+    async def get_forecast_by_city_id(self, city_id: int) -> Forecast:
+        data = await self.get("/forecast", params={"id": city_id, "appid": self.api_key})
+        return Forecast.parse_obj(data)
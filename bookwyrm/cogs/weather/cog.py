@@ -1,21 +1,76 @@
-from typing import Any, Union
+import datetime
+import io
+import re
+import time
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import aiohttp
 import disnake
 from disnake.ext import commands
 from sqlalchemy import delete
 
-from bookwyrm import config, db, models
-from . import utils
+from bookwyrm import db, models
+from bookwyrm.utils import metrics
+from . import bulk, utils
 from .city import CityRepository
-from .client import WeatherClient
+from .client import CurrentWeather, Forecast
+from .history import ObservationRecorder
 from .params import biome_param, city_param
+from .providers import provider_from_config
+from .scheduler import BroadcastScheduler, next_run_after
+
+
+FORECAST_TTL = 30 * 60  # upstream updates forecasts every 3 hours
 
 
 class Weather(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.client = WeatherClient(aiohttp.ClientSession(loop=bot.loop), config.WEATHER_API_KEY)
+        self.http = aiohttp.ClientSession(loop=bot.loop)
+        self.client = provider_from_config(self.http)
+        self.observations = ObservationRecorder()
+        self.scheduler = BroadcastScheduler(bot, self.client, observations=self.observations)
+        self._forecasts: Dict[int, Tuple[float, Forecast]] = {}
+
+    def cog_unload(self):
+        self.scheduler.stop()
+        self.observations.stop()
+
+    # ==== helpers ====
+    async def get_current_weather(self, city_id: int) -> CurrentWeather:
+        """Gets the current weather, recording it in the city's history."""
+        weather = await self.client.get_current_weather_by_city_id(city_id)
+        self.observations.record(city_id, weather)
+        return weather
+
+    async def get_forecast(self, city_id: int) -> Forecast:
+        """Gets the forecast, reusing one fetched in the last FORECAST_TTL seconds."""
+        cached = self._forecasts.get(city_id)
+        if cached is not None and time.monotonic() - cached[0] < FORECAST_TTL:
+            return cached[1]
+        forecast = await self.client.get_forecast_by_city_id(city_id)
+        self._forecasts[city_id] = (time.monotonic(), forecast)
+        return forecast
+
+    async def resolve_biome(self, inter: disnake.ApplicationCommandInteraction, biome) -> Optional[models.Biome]:
+        """
+        Returns the given biome, or the biome linked to the channel the command was run in. If neither exists, tells
+        the user and returns None.
+        """
+        if biome is not None:
+            return biome
+
+        if isinstance(inter.channel, disnake.Thread):
+            channel_id = inter.channel.parent_id
+        else:
+            channel_id = inter.channel_id
+
+        async with db.async_session() as session:
+            channel_link = await utils.get_channel_map_by_id(session, channel_id, load_biome=True)
+        if channel_link is None:
+            await inter.send("This channel is not linked to a biome", ephemeral=True)
+            return None
+        return channel_link.biome
 
     async def cog_slash_command_check(self, inter: disnake.ApplicationCommandInteraction) -> bool:
         """All weather commands must be run in a guild"""
@@ -23,6 +78,12 @@ class Weather(commands.Cog):
             raise commands.CheckFailure("This command can only be run in a server")
         return True
 
+    async def cog_before_slash_command_invoke(self, inter: disnake.ApplicationCommandInteraction):
+        metrics.start_slash_command(inter)
+
+    async def cog_after_slash_command_invoke(self, inter: disnake.ApplicationCommandInteraction):
+        metrics.finish_slash_command(inter)
+
     # ==== public ====
     @commands.slash_command(description="Shows the weather")
     async def weather(
@@ -30,25 +91,46 @@ class Weather(commands.Cog):
         inter: disnake.ApplicationCommandInteraction,
         biome: Any = biome_param(None, desc="The ID of the biome to get the weather of")
     ):
-        # specific biome
-        if biome is not None:
-            biome_weather = await self.client.get_current_weather_by_city_id(biome.city_id)
-            await inter.send(embed=utils.weather_embed(biome, biome_weather))
+        biome = await self.resolve_biome(inter, biome)
+        if biome is None:
             return
+        biome_weather = await self.get_current_weather(biome.city_id)
+        await inter.send(embed=utils.weather_embed(biome, biome_weather))
 
-        # channel biome
-        if isinstance(inter.channel, disnake.Thread):
-            channel_id = inter.channel.parent_id
-        else:
-            channel_id = inter.channel_id
+    @commands.slash_command(description="Shows the forecast for the next 5 days")
+    async def forecast(
+        self,
+        inter: disnake.ApplicationCommandInteraction,
+        biome: Any = biome_param(None, desc="The ID of the biome to get the forecast of")
+    ):
+        biome = await self.resolve_biome(inter, biome)
+        if biome is None:
+            return
+        forecast = await self.get_forecast(biome.city_id)
+        await inter.send(embed=utils.forecast_embed(biome, forecast))
 
-        async with db.async_session() as session:
-            channel_link = await utils.get_channel_map_by_id(session, channel_id, load_biome=True)
-        if channel_link is None:
-            await inter.send("This channel is not linked to a biome", ephemeral=True)
+    @commands.slash_command(description="Shows the recent weather")
+    async def history(
+        self,
+        inter: disnake.ApplicationCommandInteraction,
+        biome: Any = biome_param(None, desc="The ID of the biome to get the history of"),
+        hours: int = commands.Param(24, min_value=1, max_value=168, desc="How many hours of readings to summarize"),
+        days: int = commands.Param(7, min_value=1, max_value=14, desc="How many days of highs and lows to show")
+    ):
+        biome = await self.resolve_biome(inter, biome)
+        if biome is None:
             return
-        biome_weather = await self.client.get_current_weather_by_city_id(channel_link.biome.city_id)
-        await inter.send(embed=utils.weather_embed(channel_link.biome, biome_weather))
+        # include anything still waiting to be written
+        pending = self.observations.pending(biome.city_id)
+        now = datetime.datetime.utcnow()
+        async with db.async_session() as session:
+            observations = await utils.get_observations_since(
+                session, biome.city_id, now - datetime.timedelta(hours=hours), pending
+            )
+            daily_ranges = await utils.get_daily_temperature_range(
+                session, biome.city_id, now - datetime.timedelta(days=days - 1), pending
+            )
+        await inter.send(embed=utils.history_embed(biome, hours, observations, daily_ranges))
 
     @commands.slash_command(description="Shows the weather in all areas")
     async def summary(self, inter: disnake.ApplicationCommandInteraction):
@@ -65,7 +147,7 @@ class Weather(commands.Cog):
         embed.colour = disnake.Color.random()
 
         for biome in biomes:
-            weather = await self.client.get_current_weather_by_city_id(biome.city_id)
+            weather = await self.get_current_weather(biome.city_id)
             biome_desc = (
                 f"{int(utils.k_to_f(weather.main.temp))}\u00b0F ({int(utils.k_to_c(weather.main.temp))}\u00b0C) - "
                 f"{', '.join(weather_detail.main for weather_detail in weather.weather)}"
@@ -189,3 +271,170 @@ class Weather(commands.Cog):
             await session.commit()
 
         await inter.send(f"Deleted the biome `{biome.name}` (ID {biome.id}).")
+
+    # ---- schedule ----
+    @weatheradmin.sub_command_group(name='schedule')
+    async def weatheradmin_schedule(self, inter: disnake.ApplicationCommandInteraction):
+        pass
+
+    @weatheradmin_schedule.sub_command(name='set', description="Post the weather in every linked channel regularly")
+    async def weatheradmin_schedule_set(
+        self,
+        inter: disnake.ApplicationCommandInteraction,
+        every: int = commands.Param(None, min_value=15, desc="Post every this many minutes"),
+        daily_at: str = commands.Param(None, desc="Post once a day at this time (HH:MM, UTC)")
+    ):
+        if (every is None) == (daily_at is None):
+            raise commands.BadArgument("Choose exactly one of `every` or `daily_at`")
+        daily_at_minute = None
+        if daily_at is not None:
+            try:
+                daily_at_time = datetime.datetime.strptime(daily_at, '%H:%M')
+            except ValueError as e:
+                raise commands.BadArgument("`daily_at` should look like 18:30") from e
+            daily_at_minute = daily_at_time.hour * 60 + daily_at_time.minute
+
+        now = datetime.datetime.utcnow()
+        async with db.async_session() as session:
+            schedule = await utils.get_schedule_by_guild(session, inter.guild_id)
+            if schedule is None:
+                schedule = models.BroadcastSchedule(guild_id=inter.guild_id)
+                session.add(schedule)
+            schedule.interval_minutes = every
+            schedule.daily_at_minute = daily_at_minute
+            # the first interval post goes out on the next tick; daily posts wait for the time of day
+            schedule.next_run_at = now if every is not None else next_run_after(schedule, now)
+            # drop whatever was still pending from the old schedule
+            await session.execute(
+                delete(models.BroadcastDelivery).where(models.BroadcastDelivery.guild_id == inter.guild_id)
+            )
+            await session.commit()
+        await inter.send(
+            f"The weather will be posted in every linked channel, "
+            f"starting <t:{int(_utc_timestamp(schedule.next_run_at))}:R>."
+        )
+
+    @weatheradmin_schedule.sub_command(name='show', description="Show when the weather will next be posted")
+    async def weatheradmin_schedule_show(self, inter: disnake.ApplicationCommandInteraction):
+        async with db.async_session() as session:
+            schedule = await utils.get_schedule_by_guild(session, inter.guild_id)
+        if schedule is None:
+            await inter.send("This server has no weather schedule. Make one with `/weatheradmin schedule set`.")
+            return
+        if schedule.interval_minutes:
+            cadence = f"every {schedule.interval_minutes} minutes"
+        else:
+            cadence = f"daily at {schedule.daily_at_minute // 60:02}:{schedule.daily_at_minute % 60:02} UTC"
+        await inter.send(
+            f"The weather is posted {cadence}. Next post: <t:{int(_utc_timestamp(schedule.next_run_at))}:R>."
+        )
+
+    @weatheradmin_schedule.sub_command(name='clear', description="Stop posting the weather regularly")
+    async def weatheradmin_schedule_clear(self, inter: disnake.ApplicationCommandInteraction):
+        async with db.async_session() as session:
+            await session.execute(
+                delete(models.BroadcastSchedule).where(models.BroadcastSchedule.guild_id == inter.guild_id)
+            )
+            await session.execute(
+                delete(models.BroadcastDelivery).where(models.BroadcastDelivery.guild_id == inter.guild_id)
+            )
+            await session.commit()
+        await inter.send("Removed this server's weather schedule.")
+
+    # ---- bulk ----
+    @weatheradmin.sub_command_group(name='bulk')
+    async def weatheradmin_bulk(self, inter: disnake.ApplicationCommandInteraction):
+        pass
+
+    @weatheradmin_bulk.sub_command(name='import', description="Create or update biomes and channel links from a file")
+    async def weatheradmin_bulk_import(
+        self,
+        inter: disnake.ApplicationCommandInteraction,
+        file: disnake.Attachment = commands.Param(
+            desc="A JSON or CSV file, like the one from /weatheradmin bulk export"
+        )
+    ):
+        try:
+            specs = bulk.parse_biome_file(await file.read(), file.filename)
+            bulk.validate_specs(specs)
+        except ValueError as e:
+            raise commands.BadArgument(str(e)) from e
+        for spec in specs:
+            self._check_guild_channels(inter, spec.channels)
+
+        async with db.async_session() as session:
+            result = await bulk.upsert_biomes(session, inter.guild_id, specs)
+            await session.commit()
+        await inter.send(
+            f"Created {result.biomes_created} and updated {result.biomes_updated} biomes, "
+            f"and linked {result.channels_linked} channels."
+        )
+
+    @weatheradmin_bulk.sub_command(name='export', description="Export this server's biomes and channel links")
+    async def weatheradmin_bulk_export(
+        self,
+        inter: disnake.ApplicationCommandInteraction,
+        file_format: str = commands.Param('json', name='format', choices=['json', 'csv'], desc="The file format")
+    ):
+        async with db.async_session() as session:
+            biomes = await utils.get_biomes_by_guild(session, inter.guild_id, load_channel_links=True)
+        if file_format == 'csv':
+            data = bulk.export_biomes_csv(biomes)
+        else:
+            data = bulk.export_biomes_json(biomes)
+        await inter.send(
+            f"Exported {len(biomes)} biomes.",
+            file=disnake.File(io.BytesIO(data.encode()), filename=f"biomes-{inter.guild_id}.{file_format}")
+        )
+
+    @weatheradmin_bulk.sub_command(name='link', description="Link many channels, or a whole category, to a biome")
+    async def weatheradmin_bulk_link(
+        self,
+        inter: disnake.ApplicationCommandInteraction,
+        biome: Any = biome_param(desc="The biome the channels should use for weather"),
+        channels: str = commands.Param(None, desc="Channel mentions or IDs to link"),
+        category: disnake.CategoryChannel = commands.Param(None, desc="Link every text channel in this category")
+    ):
+        channel_ids = [int(c) for c in re.findall(r'\d{15,20}', channels or '')]
+        if category is not None:
+            channel_ids.extend(c.id for c in category.text_channels)
+        if not channel_ids:
+            raise commands.BadArgument("Give me some channels or a category to link")
+        self._check_guild_channels(inter, channel_ids)
+
+        async with db.async_session() as session:
+            linked = await bulk.link_channels(session, {channel_id: biome.id for channel_id in channel_ids})
+            await session.commit()
+        await inter.send(f"Linked {linked} channels to **{biome.name}**.")
+
+    @weatheradmin_bulk.sub_command(name='clone', description="Copy the biomes from another server into this one")
+    async def weatheradmin_bulk_clone(
+        self,
+        inter: disnake.ApplicationCommandInteraction,
+        source_server: str = commands.Param(desc="The ID of the server to copy biomes from")
+    ):
+        # you can only copy from servers you could manage biomes in
+        source_guild = self.bot.get_guild(int(source_server)) if source_server.isdigit() else None
+        source_member = source_guild.get_member(inter.author.id) if source_guild is not None else None
+        if source_member is None or not any(r.name == 'Dragonspeaker' for r in source_member.roles):
+            raise commands.CheckFailure("You must be a Dragonspeaker in the source server")
+
+        async with db.async_session() as session:
+            result = await bulk.clone_biomes(session, source_guild.id, inter.guild_id)
+            await session.commit()
+        await inter.send(
+            f"Copied the biomes from {source_guild.name}: created {result.biomes_created} and updated "
+            f"{result.biomes_updated}. Link them to some channels with `/weatheradmin bulk link`!"
+        )
+
+    @staticmethod
+    def _check_guild_channels(inter: disnake.ApplicationCommandInteraction, channel_ids: List[int]):
+        """Channel links can only point at text channels in the server the command was run in."""
+        for channel_id in channel_ids:
+            if not isinstance(inter.guild.get_channel(channel_id), disnake.TextChannel):
+                raise commands.BadArgument(f"<#{channel_id}> ({channel_id}) is not a text channel in this server")
+
+
+def _utc_timestamp(dt: datetime.datetime) -> float:
+    """Schedules are stored as naive UTC datetimes"""
+    return dt.replace(tzinfo=datetime.timezone.utc).timestamp()
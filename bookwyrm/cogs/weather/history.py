@@ -0,0 +1,171 @@
+import asyncio
+import datetime
+import itertools
+import logging
+from typing import List, Optional, Set
+
+from sqlalchemy import Integer, cast, delete, func, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from bookwyrm import db, models
+from .client import CurrentWeather
+
+log = logging.getLogger(__name__)
+
+SECONDS_PER_DAY = 86400
+# raw observations answer "last N hours"; anything older is kept only as daily min/max/mean
+RAW_RETENTION = datetime.timedelta(days=7)
+DAILY_RETENTION = datetime.timedelta(days=365)
+
+
+def to_unix(dt: datetime.datetime) -> int:
+    """Unix seconds of a datetime; naive datetimes are assumed to be UTC."""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return int(dt.timestamp())
+
+
+def to_day(dt: datetime.datetime) -> int:
+    """Days since the unix epoch (UTC)."""
+    return to_unix(dt) // SECONDS_PER_DAY
+
+
+def observation_row(city_id: int, weather: CurrentWeather) -> dict:
+    return {
+        'city_id': city_id,
+        'ts': to_unix(weather.dt),
+        'temp': round(weather.main.temp * 10),
+        'humidity': weather.main.humidity,
+        'pressure': weather.main.pressure,
+        'wind_speed': round(weather.wind.speed * 10),
+        'wind_deg': weather.wind.deg,
+        'condition_id': weather.weather[0].id if weather.weather else 0
+    }
+
+
+async def compact(
+    session,
+    now: datetime.datetime,
+    raw_retention: datetime.timedelta = RAW_RETENTION,
+    daily_retention: datetime.timedelta = DAILY_RETENTION
+):
+    """
+    Folds raw observations from whole days older than *raw_retention* into the daily table, deletes them, and
+    deletes daily rows older than *daily_retention*. Does not commit.
+    """
+    obs = models.WeatherObservation.__table__
+    daily = models.WeatherDaily.__table__
+    cutoff_ts = to_day(now - raw_retention) * SECONDS_PER_DAY
+
+    day = cast(obs.c.ts / SECONDS_PER_DAY, Integer)
+    downsampled = (
+        select(obs.c.city_id, day, func.min(obs.c.temp), func.max(obs.c.temp), func.sum(obs.c.temp), func.count())
+        .where(obs.c.ts < cutoff_ts)
+        .group_by(obs.c.city_id, day)
+    )
+    stmt = sqlite_insert(daily).from_select(
+        ['city_id', 'day', 'temp_min', 'temp_max', 'temp_sum', 'samples'], downsampled
+    )
+    # a day can already have a row if late observations trickle in after it was compacted
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['city_id', 'day'],
+        set_={
+            'temp_min': func.min(daily.c.temp_min, stmt.excluded.temp_min),
+            'temp_max': func.max(daily.c.temp_max, stmt.excluded.temp_max),
+            'temp_sum': daily.c.temp_sum + stmt.excluded.temp_sum,
+            'samples': daily.c.samples + stmt.excluded.samples
+        }
+    )
+    await session.execute(stmt)
+    await session.execute(delete(obs).where(obs.c.ts < cutoff_ts))
+    await session.execute(delete(daily).where(daily.c.day < to_day(now - daily_retention)))
+
+
+class ObservationRecorder:
+    """
+    Buffers current-weather observations in memory and writes them to the history tables in batches, so recording
+    every upstream response costs one executemany per *flush_interval* rather than a commit per request. Readers
+    that need to be up to date should merge in pending().
+    """
+
+    def __init__(self, flush_interval: float = 60, max_buffer: int = 500, compact_interval: float = 3600):
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.compact_interval = compact_interval
+        self._buffer: List[dict] = []
+        self._flushing: List[dict] = []
+        self._task: Optional[asyncio.Task] = None
+        self._flush_tasks: Set[asyncio.Task] = set()
+        self._flush_lock = asyncio.Lock()
+
+    def record(self, city_id: int, weather: CurrentWeather):
+        self._buffer.append(observation_row(city_id, weather))
+        if len(self._buffer) >= self.max_buffer and not self._flush_tasks:
+            self._flush_in_background()
+
+    def pending(self, city_id: int) -> List[models.WeatherObservation]:
+        """Returns the city's observations that haven't been written to the database yet."""
+        return [
+            models.WeatherObservation(**row)
+            for row in itertools.chain(self._flushing, self._buffer) if row['city_id'] == city_id
+        ]
+
+    async def flush(self):
+        async with self._flush_lock:
+            self._flushing, self._buffer = self._buffer, []
+            if not self._flushing:
+                return
+            # the same observation is often fetched many times before upstream updates it, which also makes it safe
+            # to write rows again after a failed flush
+            stmt = sqlite_insert(models.WeatherObservation.__table__).on_conflict_do_nothing()
+            try:
+                async with db.async_session() as session:
+                    await session.execute(stmt, self._flushing)
+                    await session.commit()
+            except BaseException:
+                # e.g. the database is locked; keep the rows for the next flush
+                self._buffer = self._flushing + self._buffer
+                raise
+            finally:
+                self._flushing = []
+
+    def _flush_in_background(self):
+        # the event loop only keeps weak references to tasks, so hold on to it until it's done
+        task = asyncio.ensure_future(self._flush_logged())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def _flush_logged(self):
+        try:
+            await self.flush()
+        except Exception:
+            log.exception("Error writing weather history")
+
+    async def compact(self, now: datetime.datetime = None):
+        now = now or datetime.datetime.utcnow()
+        async with db.async_session() as session:
+            await compact(session, now)
+            await session.commit()
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        if self._task is None:
+            self._task = loop.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._flush_in_background()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        last_compact = loop.time()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if loop.time() - last_compact >= self.compact_interval:
+                    await self.compact()
+                    last_compact = loop.time()
+            except Exception:
+                log.exception("Error writing weather history")
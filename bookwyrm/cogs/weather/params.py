@@ -3,11 +3,13 @@ from disnake.ext import commands
 from rapidfuzz import fuzz, process
 
 from bookwyrm import db, models
+from bookwyrm.utils import metrics
 from . import utils
 from .city import City, CityRepository
 
 
 # ==== city ====
+@metrics.timed_autocomplete('city')
 async def city_autocomplete(
     _: disnake.ApplicationCommandInteraction,
     arg: str,
@@ -19,7 +21,7 @@ async def city_autocomplete(
         names = [key(d) for d in CityRepository.cities]
         fuzzy_map = {key(d): d for d in CityRepository.cities}
         results = process.extract(arg, names, scorer=fuzz.partial_ratio)
-        city_results = [fuzzy_map[name] for name, score in results]
+        city_results = [fuzzy_map[name] for name, _, _ in results]
     return [f"{c.name}, {c.state} - {c.id}" for c in city_results]
 
 
@@ -40,6 +42,7 @@ def city_param(default=..., **kwargs) -> commands.Param:
 
 
 # ==== biome ====
+@metrics.timed_autocomplete('biome')
 async def biome_autocomplete(
     inter: disnake.ApplicationCommandInteraction,
     arg: str,
@@ -54,18 +57,19 @@ async def biome_autocomplete(
         names = [key(d) for d in available_biomes]
         fuzzy_map = {key(d): d for d in available_biomes}
         results = process.extract(arg, names, scorer=fuzz.partial_ratio)
-        biome_results = [fuzzy_map[name] for name, score in results]
+        biome_results = [fuzzy_map[name] for name, _, _ in results]
     return [f"{b.name} - {b.id}" for b in biome_results]
 
 
-async def biome_converter(_: disnake.ApplicationCommandInteraction, arg: str) -> models.Biome:
+async def biome_converter(inter: disnake.ApplicationCommandInteraction, arg: str) -> models.Biome:
     try:
         _, biome_id = arg.rsplit('- ', 1)
         biome_id = int(biome_id)
     except ValueError as e:
         raise ValueError("Invalid biome selection") from e
     async with db.async_session() as session:
-        biome = await utils.get_biome_by_id(session, biome_id)
+        # biomes from other servers can't be used, even if their ID is typed in by hand
+        biome = await utils.get_biome_by_id(session, biome_id, guild_id=inter.guild_id)
     return biome
 
 
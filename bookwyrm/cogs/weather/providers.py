@@ -0,0 +1,351 @@
+import asyncio
+import dataclasses
+import json
+import logging
+import os
+import time
+from typing import Dict, List, Sequence
+
+import aiohttp
+
+from bookwyrm import config
+from bookwyrm.utils import metrics
+from bookwyrm.utils.httpclient import BaseClient
+from .city import City, CityRepository
+from .client import CurrentWeather, Forecast, WeatherClient, WeatherProvider
+
+log = logging.getLogger(__name__)
+
+
+# ==== open-meteo ====
+# https://open-meteo.com/en/docs - WMO weather code -> (OpenWeatherMap condition id, main, description, icon)
+WMO_CONDITIONS = {
+    0: (800, "Clear", "clear sky", "01"),
+    1: (801, "Clouds", "mainly clear", "02"),
+    2: (802, "Clouds", "partly cloudy", "03"),
+    3: (804, "Clouds", "overcast", "04"),
+    45: (741, "Fog", "fog", "50"),
+    48: (741, "Fog", "depositing rime fog", "50"),
+    51: (300, "Drizzle", "light drizzle", "09"),
+    53: (301, "Drizzle", "drizzle", "09"),
+    55: (302, "Drizzle", "dense drizzle", "09"),
+    56: (612, "Snow", "light freezing drizzle", "13"),
+    57: (612, "Snow", "dense freezing drizzle", "13"),
+    61: (500, "Rain", "slight rain", "10"),
+    63: (501, "Rain", "moderate rain", "10"),
+    65: (502, "Rain", "heavy rain", "10"),
+    66: (511, "Rain", "light freezing rain", "13"),
+    67: (511, "Rain", "heavy freezing rain", "13"),
+    71: (600, "Snow", "slight snow fall", "13"),
+    73: (601, "Snow", "moderate snow fall", "13"),
+    75: (602, "Snow", "heavy snow fall", "13"),
+    77: (600, "Snow", "snow grains", "13"),
+    80: (520, "Rain", "slight rain showers", "09"),
+    81: (521, "Rain", "moderate rain showers", "09"),
+    82: (522, "Rain", "violent rain showers", "09"),
+    85: (621, "Snow", "slight snow showers", "13"),
+    86: (622, "Snow", "heavy snow showers", "13"),
+    95: (211, "Thunderstorm", "thunderstorm", "11"),
+    96: (201, "Thunderstorm", "thunderstorm with slight hail", "11"),
+    99: (202, "Thunderstorm", "thunderstorm with heavy hail", "11"),
+}
+OPEN_METEO_HOURLY = (
+    'temperature_2m', 'relativehumidity_2m', 'surface_pressure', 'visibility', 'weathercode', 'windspeed_10m',
+    'winddirection_10m', 'precipitation_probability'
+)
+
+
+def _wmo_detail(code: int) -> dict:
+    owm_id, main, description, icon = WMO_CONDITIONS.get(code, (800, "Clear", "clear sky", "01"))
+    return {'id': owm_id, 'main': main, 'description': description, 'icon': f"{icon}d"}
+
+
+class OpenMeteoProvider(BaseClient, WeatherProvider):
+    """Open-Meteo needs no API key, but looks cities up by coordinates instead of ID."""
+    SERVICE_BASE = "https://api.open-meteo.com/v1"
+    name = 'openmeteo'
+
+    async def _get_hourly(self, city: City, forecast_days: int = 7) -> dict:
+        return await self.get("/forecast", params={
+            'latitude': city.coord.lat,
+            'longitude': city.coord.lon,
+            'current_weather': 'true',
+            'hourly': ','.join(OPEN_METEO_HOURLY),
+            'forecast_days': forecast_days,
+            'windspeed_unit': 'ms',
+            'timeformat': 'unixtime',
+            # times stay unix timestamps, but utc_offset_seconds becomes the city's offset like OpenWeatherMap's
+            'timezone': 'auto'
+        })
+
+    @staticmethod
+    def _get_city(city_id: int) -> City:
+        city = CityRepository.get_city(city_id)
+        if city is None:
+            raise RuntimeError(f"Unknown city: {city_id}")
+        return city
+
+    @staticmethod
+    def _hourly_at(hourly: dict, idx: int, key: str, default=0):
+        values = hourly.get(key)
+        if not values or values[idx] is None:
+            return default
+        return values[idx]
+
+    async def get_current_weather_by_city_id(self, city_id: int) -> CurrentWeather:
+        city = self._get_city(city_id)
+        # only the current hour is needed, so don't download the whole week
+        data = await self._get_hourly(city, forecast_days=1)
+        current = data['current_weather']
+        hourly = data['hourly']
+        # the current conditions don't include humidity, pressure, or visibility; use this hour's values
+        idx = min(range(len(hourly['time'])), key=lambda i: abs(hourly['time'][i] - current['time']))
+        temp = current['temperature'] + 273.15
+        return CurrentWeather(
+            coord=city.coord,
+            weather=[_wmo_detail(current['weathercode'])],
+            main={
+                'temp': temp,
+                'pressure': round(self._hourly_at(hourly, idx, 'surface_pressure')),
+                'humidity': round(self._hourly_at(hourly, idx, 'relativehumidity_2m')),
+                'temp_min': temp,
+                'temp_max': temp
+            },
+            visibility=round(self._hourly_at(hourly, idx, 'visibility', 10000)),
+            wind={'speed': current['windspeed'], 'deg': round(current['winddirection'])},
+            dt=current['time'],
+            id=city.id,
+            name=city.name
+        )
+
+    async def get_forecast_by_city_id(self, city_id: int) -> Forecast:
+        city = self._get_city(city_id)
+        data = await self._get_hourly(city)
+        hourly = data['hourly']
+        now = time.time()
+        # match OpenWeatherMap's 5 days in 3 hour steps. The hours are local, so they aren't always whole UTC hours
+        indices = [i for i, t in enumerate(hourly['time']) if t >= now - 3600][::3][:40]
+        entries = []
+        for i in indices:
+            temp = self._hourly_at(hourly, i, 'temperature_2m') + 273.15
+            entries.append({
+                'dt': hourly['time'][i],
+                'main': {
+                    'temp': temp,
+                    'pressure': round(self._hourly_at(hourly, i, 'surface_pressure')),
+                    'humidity': round(self._hourly_at(hourly, i, 'relativehumidity_2m')),
+                    'temp_min': temp,
+                    'temp_max': temp
+                },
+                'weather': [_wmo_detail(self._hourly_at(hourly, i, 'weathercode'))],
+                'wind': {
+                    'speed': self._hourly_at(hourly, i, 'windspeed_10m'),
+                    'deg': round(self._hourly_at(hourly, i, 'winddirection_10m'))
+                },
+                'visibility': round(self._hourly_at(hourly, i, 'visibility', 10000)),
+                'pop': self._hourly_at(hourly, i, 'precipitation_probability') / 100
+            })
+        return Forecast(
+            cnt=len(entries),
+            entries=entries,
+            city={
+                'id': city.id,
+                'name': city.name,
+                'coord': city.coord,
+                'country': city.country,
+                'timezone': data.get('utc_offset_seconds', 0)
+            }
+        )
+
+
+# ==== record/replay ====
+class RecordingProvider(WeatherProvider):
+    """
+    Passes requests through to another provider and saves each response under *directory*, in the layout
+    ReplayProvider reads. Only the latest response per city is kept.
+    """
+    name = 'recording'
+
+    def __init__(self, inner: WeatherProvider, directory: str):
+        self.inner = inner
+        self.directory = directory
+        os.makedirs(os.path.join(directory, 'current'), exist_ok=True)
+        os.makedirs(os.path.join(directory, 'forecast'), exist_ok=True)
+
+    def _save(self, kind: str, city_id: int, model):
+        with open(os.path.join(self.directory, kind, f"{city_id}.json"), 'w') as f:
+            f.write(model.json(by_alias=True))
+
+    async def get_current_weather_by_city_id(self, city_id: int) -> CurrentWeather:
+        weather = await self.inner.get_current_weather_by_city_id(city_id)
+        self._save('current', city_id, weather)
+        return weather
+
+    async def get_forecast_by_city_id(self, city_id: int) -> Forecast:
+        forecast = await self.inner.get_forecast_by_city_id(city_id)
+        self._save('forecast', city_id, forecast)
+        return forecast
+
+
+class ReplayProvider(WeatherProvider):
+    """
+    Serves responses saved by RecordingProvider. Everything is parsed once when the provider is created, so requests
+    are answered from memory. If *strict* is False, cities that weren't recorded are answered with another city's
+    recording instead of an error, which lets benchmarks use arbitrary cities.
+    """
+    name = 'replay'
+
+    def __init__(self, directory: str, strict: bool = True):
+        self.strict = strict
+        self.current: Dict[int, CurrentWeather] = self._load(os.path.join(directory, 'current'), CurrentWeather)
+        self.forecasts: Dict[int, Forecast] = self._load(os.path.join(directory, 'forecast'), Forecast)
+        self._current_ids = sorted(self.current)
+        self._forecast_ids = sorted(self.forecasts)
+
+    @staticmethod
+    def _load(directory: str, model) -> dict:
+        out = {}
+        if not os.path.isdir(directory):
+            return out
+        for filename in os.listdir(directory):
+            city_id, ext = os.path.splitext(filename)
+            if ext != '.json' or not city_id.isdigit():
+                continue
+            with open(os.path.join(directory, filename)) as f:
+                out[int(city_id)] = model.parse_obj(json.load(f))
+        return out
+
+    def _lookup(self, recordings: dict, ids: List[int], city_id: int):
+        if city_id in recordings:
+            return recordings[city_id]
+        if self.strict or not ids:
+            raise RuntimeError(f"No recorded weather for city {city_id}")
+        return recordings[ids[city_id % len(ids)]]
+
+    async def get_current_weather_by_city_id(self, city_id: int) -> CurrentWeather:
+        return self._lookup(self.current, self._current_ids, city_id)
+
+    async def get_forecast_by_city_id(self, city_id: int) -> Forecast:
+        return self._lookup(self.forecasts, self._forecast_ids, city_id)
+
+
+# ==== failover ====
+@dataclasses.dataclass
+class _ProviderHealth:
+    latency: float = 0.0  # exponentially weighted moving average, in seconds
+    last_sample: float = 0.0
+    failures: int = 0  # consecutive
+    down_until: float = 0.0
+
+
+class FailoverProvider(WeatherProvider):
+    """
+    Sends each request to the healthy provider with the lowest recent latency, falling through to the next one if it
+    fails or takes longer than *attempt_timeout* seconds. A provider that fails is skipped for *cooldown* seconds,
+    doubling each time it fails again after its cooldown ran out, up to *max_cooldown*; requests that fail together
+    while it's already cooling down don't make it longer. A provider with no latency sample in the last
+    *probe_interval* seconds is tried first again, so a slow primary gets a chance to prove it has recovered.
+    """
+    name = 'failover'
+
+    def __init__(
+        self,
+        providers: Sequence[WeatherProvider],
+        attempt_timeout: float = 2.0,
+        cooldown: float = 30,
+        max_cooldown: float = 600,
+        probe_interval: float = 300,
+        smoothing: float = 0.2
+    ):
+        if not providers:
+            raise ValueError("FailoverProvider needs at least one provider")
+        self.providers = list(providers)
+        # below discord's 3 second interaction deadline, so a hanging provider fails over in time
+        self.attempt_timeout = attempt_timeout
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.probe_interval = probe_interval
+        self.smoothing = smoothing
+        self.health = [_ProviderHealth() for _ in self.providers]
+
+    def ranked(self) -> List[int]:
+        """Indices of the providers, in the order they should be tried."""
+        now = time.monotonic()
+
+        def key(idx):
+            health = self.health[idx]
+            latency = health.latency if now - health.last_sample < self.probe_interval else 0.0
+            return health.down_until > now, latency
+
+        # sorted() is stable, so ties go to the provider listed first
+        return sorted(range(len(self.providers)), key=key)
+
+    def _record_success(self, idx: int, latency: float):
+        health = self.health[idx]
+        if health.last_sample:
+            health.latency += self.smoothing * (latency - health.latency)
+        else:
+            health.latency = latency
+        health.last_sample = time.monotonic()
+        health.failures = 0
+        health.down_until = 0.0
+
+    def _record_failure(self, idx: int):
+        health = self.health[idx]
+        now = time.monotonic()
+        if health.down_until > now:
+            # another request already failed in this outage
+            return
+        health.failures += 1
+        health.down_until = now + min(self.cooldown * 2 ** (health.failures - 1), self.max_cooldown)
+
+    async def _call(self, method: str, city_id: int):
+        last_error = None
+        for idx in self.ranked():
+            provider = self.providers[idx]
+            start = time.perf_counter()
+            try:
+                result = await asyncio.wait_for(getattr(provider, method)(city_id), self.attempt_timeout)
+            except Exception as e:
+                self._record_failure(idx)
+                metrics.WEATHER_PROVIDER_LATENCY.observe(
+                    time.perf_counter() - start, provider=provider.name, method=method, outcome='error'
+                )
+                log.warning(f"Weather provider {provider.name} failed, trying the next one: {e!r}")
+                last_error = e
+                continue
+            latency = time.perf_counter() - start
+            self._record_success(idx, latency)
+            metrics.WEATHER_PROVIDER_LATENCY.observe(latency, provider=provider.name, method=method, outcome='ok')
+            return result
+        raise RuntimeError("Could not get the weather from any provider. Please try again in a few minutes.") \
+            from last_error
+
+    async def get_current_weather_by_city_id(self, city_id: int) -> CurrentWeather:
+        return await self._call('get_current_weather_by_city_id', city_id)
+
+    async def get_forecast_by_city_id(self, city_id: int) -> Forecast:
+        return await self._call('get_forecast_by_city_id', city_id)
+
+
+# ==== config ====
+def provider_from_config(http: aiohttp.ClientSession) -> WeatherProvider:
+    """Builds the provider chain described by the WEATHER_PROVIDER* and WEATHER_*_DIR env variables."""
+    providers = []
+    for name in config.WEATHER_PROVIDERS:
+        if name == WeatherClient.name:
+            providers.append(WeatherClient(http, config.WEATHER_API_KEY))
+        elif name == OpenMeteoProvider.name:
+            providers.append(OpenMeteoProvider(http))
+        elif name == ReplayProvider.name:
+            providers.append(ReplayProvider(config.WEATHER_REPLAY_DIR))
+        else:
+            raise ValueError(f"Unknown weather provider: {name}")
+
+    if len(providers) == 1:
+        provider = providers[0]
+    else:
+        provider = FailoverProvider(providers, attempt_timeout=config.WEATHER_PROVIDER_TIMEOUT)
+    if config.WEATHER_RECORD_DIR:
+        provider = RecordingProvider(provider, config.WEATHER_RECORD_DIR)
+    return provider
@@ -0,0 +1,269 @@
+import asyncio
+import datetime
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import disnake
+from sqlalchemy import bindparam, delete, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from bookwyrm import db, models
+from bookwyrm.utils import metrics
+from . import utils
+from .client import CurrentWeather, WeatherProvider
+from .history import ObservationRecorder
+
+log = logging.getLogger(__name__)
+
+MAX_SEND_ATTEMPTS = 5
+# delivery outcomes after which a channel won't be sent to again for the same slot
+FINAL_OUTCOMES = {'sent', 'missing_channel', 'unlinked', 'rejected', 'dropped'}
+
+
+def next_run_after(schedule: models.BroadcastSchedule, now: datetime.datetime) -> datetime.datetime:
+    """
+    Returns the first slot of the schedule strictly after *now*. Slots missed while the bot was offline are
+    skipped, not replayed; the caller runs a late schedule once and then moves on to the next slot.
+    """
+    if schedule.interval_minutes:
+        interval = datetime.timedelta(minutes=schedule.interval_minutes)
+        missed = (now - schedule.next_run_at) // interval + 1
+        return schedule.next_run_at + max(missed, 1) * interval
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    candidate = midnight + datetime.timedelta(minutes=schedule.daily_at_minute)
+    if candidate <= now:
+        candidate += datetime.timedelta(days=1)
+    return candidate
+
+
+def latest_slot_at(schedule: models.BroadcastSchedule, now: datetime.datetime) -> datetime.datetime:
+    """Returns the last slot of the schedule at or before *now*."""
+    if schedule.interval_minutes:
+        period = datetime.timedelta(minutes=schedule.interval_minutes)
+    else:
+        period = datetime.timedelta(days=1)
+    return next_run_after(schedule, now) - period
+
+
+class BroadcastScheduler:
+    """
+    Posts the current weather to every linked channel of guilds whose broadcast schedule is due.
+
+    When a schedule comes due, a delivery row is written for each linked channel of that slot. Every tick sends to
+    the slot's channels that aren't done yet, and the schedule only moves on to its next slot once all of them are,
+    so a failed weather fetch, a send error, or a restart mid-tick is retried on the next tick. A channel is done when
+    its message was sent, when it can't be sent to (deleted channel, missing permissions), or after
+    MAX_SEND_ATTEMPTS failed sends. A slot with channels still pending when the following slot comes due is given up
+    on. Delivery is at least once: a crash between sending a message and recording it posts that message again.
+
+    Each tick fetches each city once no matter how many biomes use it, renders one embed per biome that is shared by
+    all of its channels, and sends with bounded concurrency so a large guild doesn't trip Discord's rate limits.
+    """
+
+    def __init__(
+        self,
+        bot,
+        client: WeatherProvider,
+        observations: ObservationRecorder = None,
+        tick_interval: float = 30,
+        fetch_concurrency: int = 5,
+        send_concurrency: int = 5
+    ):
+        self.bot = bot
+        self.client = client
+        self.observations = observations
+        self.tick_interval = tick_interval
+        self.fetch_concurrency = fetch_concurrency
+        self.send_concurrency = send_concurrency
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = self.bot.loop.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        await self.bot.wait_until_ready()
+        while True:
+            try:
+                await self.tick()
+            except Exception:
+                log.exception("Error running weather broadcast tick")
+            await asyncio.sleep(self.tick_interval)
+
+    async def tick(self, now: datetime.datetime = None):
+        now = now or datetime.datetime.utcnow()
+        with metrics.BROADCAST_TICK_LATENCY.time():
+            schedules, pending = await self._open_due_slots(now)
+            if not schedules:
+                return
+            outcomes: Dict[int, str] = {}
+            try:
+                weather_by_city = await self._fetch_weather({biome.city_id for _, biome in pending if biome})
+                await self._send_all(pending, weather_by_city, outcomes)
+            finally:
+                # also runs if the tick is cancelled, so messages that did go out aren't sent again
+                await self._record_outcomes(schedules, pending, outcomes, now)
+
+    async def _open_due_slots(
+        self,
+        now: datetime.datetime
+    ) -> Tuple[List[models.BroadcastSchedule], List[Tuple[models.BroadcastDelivery, Optional[models.Biome]]]]:
+        """
+        Adds a delivery row for every linked channel of each due slot that doesn't have one yet, including channels
+        linked after the slot opened, and returns the due schedules and their channels that aren't done.
+        """
+        schedule = models.BroadcastSchedule.__table__
+        channel_map = models.ChannelMap.__table__
+        biome = models.Biome.__table__
+        due_channels = (
+            select(biome.c.guild_id, schedule.c.next_run_at, channel_map.c.channel_id)
+            .select_from(
+                channel_map
+                .join(biome, biome.c.id == channel_map.c.biome_id)
+                .join(schedule, schedule.c.guild_id == biome.c.guild_id)
+            )
+            .where(schedule.c.next_run_at <= now)
+        )
+        stmt = sqlite_insert(models.BroadcastDelivery.__table__).from_select(
+            ['guild_id', 'slot_at', 'channel_id'], due_channels
+        ).on_conflict_do_nothing()
+
+        async with db.async_session() as session:
+            schedules = await utils.get_due_schedules(session, now)
+            if not schedules:
+                return [], []
+            await session.execute(stmt)
+            await session.commit()
+            pending = await utils.get_pending_deliveries(session, now)
+        return schedules, pending
+
+    async def _fetch_weather(self, city_ids) -> Dict[int, CurrentWeather]:
+        semaphore = asyncio.Semaphore(self.fetch_concurrency)
+        weather_by_city = {}
+
+        async def fetch(city_id):
+            async with semaphore:
+                try:
+                    weather = await self.client.get_current_weather_by_city_id(city_id)
+                except Exception:
+                    log.exception(f"Could not fetch the weather for city {city_id}")
+                    return
+            weather_by_city[city_id] = weather
+            if self.observations is not None:
+                self.observations.record(city_id, weather)
+
+        await asyncio.gather(*(fetch(city_id) for city_id in city_ids))
+        return weather_by_city
+
+    async def _send_all(
+        self,
+        pending: List[Tuple[models.BroadcastDelivery, Optional[models.Biome]]],
+        weather_by_city: Dict[int, CurrentWeather],
+        outcomes: Dict[int, str]
+    ):
+        """Sends to each pending channel, filling in *outcomes* (channel ID -> outcome) as sends finish."""
+        semaphore = asyncio.Semaphore(self.send_concurrency)
+        embeds = {}
+        outbox = []
+        for delivery, biome in pending:
+            if biome is None:
+                outcomes[delivery.channel_id] = 'unlinked'
+                continue
+            weather = weather_by_city.get(biome.city_id)
+            if weather is None:
+                outcomes[delivery.channel_id] = 'no_weather'
+                continue
+            if biome.id not in embeds:
+                embeds[biome.id] = utils.weather_embed(biome, weather)
+            outbox.append((delivery.channel_id, embeds[biome.id]))
+
+        async def send(channel_id, embed):
+            channel = self.bot.get_channel(channel_id)
+            if channel is None:
+                outcomes[channel_id] = 'missing_channel'
+                return
+            async with semaphore:
+                try:
+                    await channel.send(embed=embed)
+                except (disnake.Forbidden, disnake.NotFound) as e:
+                    log.warning(f"Can't send the weather broadcast to {channel_id}: {e}")
+                    outcomes[channel_id] = 'rejected'
+                except disnake.HTTPException as e:
+                    log.warning(f"Could not send the weather broadcast to {channel_id}, will retry: {e}")
+                    outcomes[channel_id] = 'error'
+                else:
+                    outcomes[channel_id] = 'sent'
+
+        await asyncio.gather(*(send(channel_id, embed) for channel_id, embed in outbox))
+
+    async def _record_outcomes(
+        self,
+        schedules: List[models.BroadcastSchedule],
+        pending: List[Tuple[models.BroadcastDelivery, Optional[models.Biome]]],
+        outcomes: Dict[int, str],
+        now: datetime.datetime
+    ):
+        """
+        Saves each channel's outcome, then moves every schedule whose slot is finished (or has been overtaken by the
+        following slot) on to its next slot.
+        """
+        updates = []
+        unfinished = {s.guild_id: 0 for s in schedules}
+        for delivery, _ in pending:
+            outcome = outcomes.get(delivery.channel_id)
+            attempts = delivery.attempts + (outcome == 'error')
+            if outcome == 'error' and attempts >= MAX_SEND_ATTEMPTS:
+                outcome = 'dropped'
+            if outcome is not None:
+                metrics.BROADCAST_MESSAGES.inc(status=outcome)
+                updates.append({
+                    'd_guild_id': delivery.guild_id,
+                    'd_slot_at': delivery.slot_at,
+                    'd_channel_id': delivery.channel_id,
+                    'd_attempts': attempts,
+                    'd_done': outcome in FINAL_OUTCOMES
+                })
+            if outcome not in FINAL_OUTCOMES:
+                unfinished[delivery.guild_id] += 1
+
+        deliveries = models.BroadcastDelivery.__table__
+        schedule_table = models.BroadcastSchedule.__table__
+        async with db.async_session() as session:
+            if updates:
+                await session.execute(
+                    update(deliveries)
+                    .where(
+                        deliveries.c.guild_id == bindparam('d_guild_id'),
+                        deliveries.c.slot_at == bindparam('d_slot_at'),
+                        deliveries.c.channel_id == bindparam('d_channel_id')
+                    )
+                    .values(attempts=bindparam('d_attempts'), done=bindparam('d_done')),
+                    updates
+                )
+            for schedule in schedules:
+                remaining = unfinished[schedule.guild_id]
+                if not remaining:
+                    next_run_at = next_run_after(schedule, now)
+                elif now >= next_run_after(schedule, schedule.next_run_at):
+                    # the following slot is already due; deliver that one instead
+                    log.warning(f"Giving up on {remaining} weather broadcasts to guild {schedule.guild_id}")
+                    metrics.BROADCAST_MESSAGES.inc(remaining, status='expired')
+                    next_run_at = latest_slot_at(schedule, now)
+                else:
+                    continue
+                # only if the slot wasn't changed by /weatheradmin schedule while this tick ran
+                await session.execute(
+                    update(schedule_table)
+                    .where(
+                        schedule_table.c.guild_id == schedule.guild_id,
+                        schedule_table.c.next_run_at == schedule.next_run_at
+                    )
+                    .values(last_run_at=now, next_run_at=next_run_at)
+                )
+                await session.execute(delete(deliveries).where(deliveries.c.guild_id == schedule.guild_id))
+            await session.commit()
@@ -1,11 +1,15 @@
-from typing import List, Optional
+import datetime
+import itertools
+from collections import Counter
+from typing import Iterable, List, Optional, Tuple
 
 import disnake
-from sqlalchemy import select
+from sqlalchemy import Integer, and_, cast, func, select
 from sqlalchemy.orm import selectinload
 
 from bookwyrm import models
-from .client import CurrentWeather, WEATHER_DESC
+from .client import CurrentWeather, Forecast, WEATHER_DESC
+from .history import SECONDS_PER_DAY, to_day, to_unix
 
 
 async def get_biome_by_id(session, biome_id: int, guild_id: int = None) -> models.Biome:
@@ -38,6 +42,103 @@ async def get_channel_map_by_id(session, channel_id: int, load_biome=False) -> O
     return result.scalar()
 
 
+async def get_schedule_by_guild(session, guild_id: int) -> Optional[models.BroadcastSchedule]:
+    """Returns the guild's broadcast schedule, or None"""
+    result = await session.execute(
+        select(models.BroadcastSchedule).where(models.BroadcastSchedule.guild_id == guild_id)
+    )
+    return result.scalar()
+
+
+async def get_due_schedules(session, now: datetime.datetime) -> List[models.BroadcastSchedule]:
+    """Returns all broadcast schedules that should have run at or before *now* (naive UTC)."""
+    result = await session.execute(
+        select(models.BroadcastSchedule).where(models.BroadcastSchedule.next_run_at <= now)
+    )
+    return result.scalars().all()
+
+
+async def get_pending_deliveries(
+    session,
+    now: datetime.datetime
+) -> List[Tuple[models.BroadcastDelivery, Optional[models.Biome]]]:
+    """
+    Returns the channels of every due broadcast slot that aren't done yet, each with the biome the channel is linked
+    to now (None if it was unlinked after the slot opened).
+    """
+    delivery = models.BroadcastDelivery
+    schedule = models.BroadcastSchedule
+    result = await session.execute(
+        select(delivery, models.Biome)
+        .join(schedule, and_(schedule.guild_id == delivery.guild_id, schedule.next_run_at == delivery.slot_at))
+        .outerjoin(models.ChannelMap, models.ChannelMap.channel_id == delivery.channel_id)
+        .outerjoin(models.Biome, models.Biome.id == models.ChannelMap.biome_id)
+        .where(schedule.next_run_at <= now, delivery.done.is_(False))
+    )
+    return result.all()
+
+
+async def get_observations_since(
+    session,
+    city_id: int,
+    since: datetime.datetime,
+    pending: Iterable[models.WeatherObservation] = ()
+) -> List[models.WeatherObservation]:
+    """
+    Returns a city's recorded observations at or after *since*, oldest first, including any *pending* observations
+    that haven't been written yet.
+    """
+    since_ts = to_unix(since)
+    result = await session.execute(
+        select(models.WeatherObservation)
+        .where(models.WeatherObservation.city_id == city_id, models.WeatherObservation.ts >= since_ts)
+    )
+    by_ts = {o.ts: o for o in pending if o.ts >= since_ts}
+    by_ts.update((o.ts, o) for o in result.scalars())
+    return [by_ts[ts] for ts in sorted(by_ts)]
+
+
+async def get_daily_temperature_range(
+    session,
+    city_id: int,
+    since: datetime.datetime,
+    pending: Iterable[models.WeatherObservation] = ()
+) -> List[Tuple[datetime.date, float, float]]:
+    """
+    Returns (UTC date, min temp, max temp) in Kelvin for each day at or after *since* with recorded history, oldest
+    first. Recent days come from raw observations and any *pending* ones, and older days from the downsampled daily
+    table.
+    """
+    obs = models.WeatherObservation
+    since_day = to_day(since)
+    day = cast(obs.ts / SECONDS_PER_DAY, Integer)
+    raw_result = await session.execute(
+        select(day, func.min(obs.temp), func.max(obs.temp))
+        .where(obs.city_id == city_id, obs.ts >= since_day * SECONDS_PER_DAY)
+        .group_by(day)
+    )
+    daily_result = await session.execute(
+        select(models.WeatherDaily.day, models.WeatherDaily.temp_min, models.WeatherDaily.temp_max)
+        .where(models.WeatherDaily.city_id == city_id, models.WeatherDaily.day >= since_day)
+    )
+
+    pending_result = [(o.ts // SECONDS_PER_DAY, o.temp, o.temp) for o in pending]
+
+    ranges = {}
+    for day_num, temp_min, temp_max in itertools.chain(daily_result, raw_result, pending_result):
+        if day_num < since_day:
+            continue
+        if day_num in ranges:
+            temp_min = min(temp_min, ranges[day_num][0])
+            temp_max = max(temp_max, ranges[day_num][1])
+        ranges[day_num] = (temp_min, temp_max)
+    epoch = datetime.date(1970, 1, 1)
+    return [
+        (epoch + datetime.timedelta(days=day_num), temp_min / 10, temp_max / 10)
+        for day_num, (temp_min, temp_max) in sorted(ranges.items())
+    ]
+
+
 def k_to_f(deg_k: float):
     """Kelvin to Fahrenheit"""
     return deg_k * 1.8 - 459.67
@@ -127,3 +228,67 @@ def weather_desc(weather: CurrentWeather) -> str:
         f"The wind is {wind_desc}, at {int(ms_to_mph(weather.wind.speed))} mph towards the {wind_direction}. "
         f"Visibility is {visibility_desc} ({visibility_detail}) with a humidity of {weather.main.humidity}%."
     )
+
+
+def forecast_embed(biome: models.Biome, forecast: Forecast) -> disnake.Embed:
+    embed = disnake.Embed()
+    embed.title = f"Forecast for {biome.name}"
+    embed.colour = disnake.Color.random()
+    if biome.image_url:
+        embed.set_thumbnail(url=biome.image_url)
+
+    city_tz = datetime.timezone(datetime.timedelta(seconds=forecast.city.timezone))
+    for date, entries in itertools.groupby(forecast.entries, key=lambda e: e.dt.astimezone(city_tz).date()):
+        entries = list(entries)
+        temp_min = min(e.main.temp_min for e in entries)
+        temp_max = max(e.main.temp_max for e in entries)
+        conditions = Counter(e.weather[0].main for e in entries if e.weather).most_common(1)
+        precipitation = max(e.pop for e in entries)
+        embed.add_field(
+            name=date.strftime("%A, %b %d"),
+            value=(
+                f"{conditions[0][0] if conditions else 'Unknown'}, "
+                f"{int(k_to_f(temp_min))}-{int(k_to_f(temp_max))}\u00b0F "
+                f"({int(k_to_c(temp_min))}-{int(k_to_c(temp_max))}\u00b0C). "
+                f"{int(precipitation * 100)}% chance of precipitation."
+            ),
+            inline=False
+        )
+    return embed
+
+
+def history_embed(
+    biome: models.Biome,
+    hours: int,
+    observations: List[models.WeatherObservation],
+    daily_ranges: List[Tuple[datetime.date, float, float]]
+) -> disnake.Embed:
+    embed = disnake.Embed()
+    embed.title = f"Weather History in {biome.name}"
+    embed.colour = disnake.Color.random()
+    if biome.image_url:
+        embed.set_thumbnail(url=biome.image_url)
+
+    if observations:
+        temp_min = min(o.temp for o in observations) / 10
+        temp_max = max(o.temp for o in observations) / 10
+        humidity = sum(o.humidity for o in observations) / len(observations)
+        embed.description = (
+            f"Over the last {hours} hours, the temperature ranged from {int(k_to_f(temp_min))}\u00b0F "
+            f"({int(k_to_c(temp_min))}\u00b0C) to {int(k_to_f(temp_max))}\u00b0F ({int(k_to_c(temp_max))}\u00b0C) "
+            f"with an average humidity of {int(humidity)}% ({len(observations)} readings)."
+        )
+    else:
+        embed.description = f"No weather has been recorded here in the last {hours} hours."
+
+    if daily_ranges:
+        embed.add_field(
+            name="Daily Highs and Lows (UTC)",
+            value='\n'.join(
+                f"{date.strftime('%a, %b %d')}: {int(k_to_f(temp_min))}-{int(k_to_f(temp_max))}\u00b0F "
+                f"({int(k_to_c(temp_min))}-{int(k_to_c(temp_max))}\u00b0C)"
+                for date, temp_min, temp_max in daily_ranges
+            ),
+            inline=False
+        )
+    return embed
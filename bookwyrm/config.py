@@ -2,3 +2,16 @@ import os
 
 TOKEN = os.getenv("TOKEN")
 WEATHER_API_KEY = os.getenv("WEATHER_API_KEY")
+# comma-separated, in order of preference: openweathermap, openmeteo, replay
+WEATHER_PROVIDERS = [p.strip() for p in os.getenv("WEATHER_PROVIDERS", "openweathermap").split(',') if p.strip()]
+# seconds to wait for one provider before failing over to the next
+WEATHER_PROVIDER_TIMEOUT = float(os.getenv("WEATHER_PROVIDER_TIMEOUT", "2"))
+# replay serves responses recorded to WEATHER_RECORD_DIR
+WEATHER_REPLAY_DIR = os.getenv(
+    "WEATHER_REPLAY_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), '../data/weather-recordings')
+)
+WEATHER_RECORD_DIR = os.getenv("WEATHER_RECORD_DIR")
+
+# metrics are served on http://METRICS_HOST:METRICS_PORT/metrics if METRICS_PORT is set
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = os.getenv("METRICS_PORT")
@@ -1,8 +1,12 @@
 import os
+import time
 
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import declarative_base, sessionmaker
 
+from .utils import metrics
+
 DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../data/bookwyrm.db')
 
 engine = create_async_engine(f'sqlite+aiosqlite:///{DATA_PATH}', echo=False)
@@ -17,6 +21,32 @@ async_session = sessionmaker(
 Base = declarative_base()
 
 
+# ==== instrumentation ====
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_times', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info['query_start_times'].pop()
+    metrics.DB_QUERY_LATENCY.observe(time.perf_counter() - start, statement=statement.split(None, 1)[0].upper())
+
+
+def _handle_error(exception_context):
+    conn = exception_context.connection
+    if conn is not None and conn.info.get('query_start_times'):
+        conn.info['query_start_times'].pop()
+
+
+def instrument(async_engine):
+    """Records the latency of every statement run on the given engine in the DB metrics."""
+    event.listen(async_engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(async_engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(async_engine.sync_engine, "handle_error", _handle_error)
+
+
+instrument(engine)
+
+
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
@@ -1,4 +1,4 @@
-from sqlalchemy import BigInteger, Column, ForeignKey, Integer, String
+from sqlalchemy import BigInteger, Boolean, Column, DateTime, ForeignKey, Integer, SmallInteger, String
 from sqlalchemy.orm import relationship
 
 from .db import Base
@@ -30,3 +30,71 @@ class ChannelMap(Base):
 
     def __repr__(self):
         return f"<{type(self).__name__} id={self.id!r} biome_id={self.biome_id!r}>"
+
+
+class BroadcastSchedule(Base):
+    __tablename__ = "broadcast_schedules"
+
+    guild_id = Column(BigInteger, primary_key=True)
+    # exactly one of these is set: post every N minutes, or daily at N minutes past midnight UTC
+    interval_minutes = Column(Integer, nullable=True)
+    daily_at_minute = Column(Integer, nullable=True)
+    # naive UTC; the slot being delivered while it's due, only advanced once every channel of the slot is done
+    next_run_at = Column(DateTime, nullable=False, index=True)
+    last_run_at = Column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return (f"<{type(self).__name__} guild_id={self.guild_id!r} interval_minutes={self.interval_minutes!r} "
+                f"daily_at_minute={self.daily_at_minute!r} next_run_at={self.next_run_at!r} "
+                f"last_run_at={self.last_run_at!r}>")
+
+
+class BroadcastDelivery(Base):
+    # one row per linked channel of a due broadcast slot; deleted when the schedule moves on to its next slot
+    __tablename__ = "broadcast_deliveries"
+
+    guild_id = Column(BigInteger, primary_key=True)
+    slot_at = Column(DateTime, primary_key=True)  # the schedule's next_run_at when the slot opened
+    channel_id = Column(BigInteger, primary_key=True)
+    attempts = Column(Integer, nullable=False, default=0)  # failed sends
+    done = Column(Boolean, nullable=False, default=False)  # sent, or given up on
+
+    def __repr__(self):
+        return (f"<{type(self).__name__} guild_id={self.guild_id!r} slot_at={self.slot_at!r} "
+                f"channel_id={self.channel_id!r} attempts={self.attempts!r} done={self.done!r}>")
+
+
+class WeatherObservation(Base):
+    # raw observations, one per city per upstream update; fixed-point columns keep rows small
+    __tablename__ = "weather_observations"
+    __table_args__ = {'sqlite_with_rowid': False}
+
+    city_id = Column(Integer, primary_key=True)
+    ts = Column(Integer, primary_key=True)  # unix seconds of the upstream observation
+    temp = Column(SmallInteger, nullable=False)  # 0.1 K
+    humidity = Column(SmallInteger, nullable=False)  # %
+    pressure = Column(SmallInteger, nullable=False)  # hPa
+    wind_speed = Column(SmallInteger, nullable=False)  # 0.1 m/s
+    wind_deg = Column(SmallInteger, nullable=False)
+    condition_id = Column(SmallInteger, nullable=False)
+
+    def __repr__(self):
+        return (f"<{type(self).__name__} city_id={self.city_id!r} ts={self.ts!r} temp={self.temp!r} "
+                f"humidity={self.humidity!r} condition_id={self.condition_id!r}>")
+
+
+class WeatherDaily(Base):
+    # observations older than the raw retention window, downsampled to one row per city per UTC day
+    __tablename__ = "weather_daily"
+    __table_args__ = {'sqlite_with_rowid': False}
+
+    city_id = Column(Integer, primary_key=True)
+    day = Column(Integer, primary_key=True)  # days since the unix epoch
+    temp_min = Column(SmallInteger, nullable=False)  # 0.1 K
+    temp_max = Column(SmallInteger, nullable=False)  # 0.1 K
+    temp_sum = Column(Integer, nullable=False)  # 0.1 K, divide by samples for the mean
+    samples = Column(Integer, nullable=False)
+
+    def __repr__(self):
+        return (f"<{type(self).__name__} city_id={self.city_id!r} day={self.day!r} temp_min={self.temp_min!r} "
+                f"temp_max={self.temp_max!r} samples={self.samples!r}>")
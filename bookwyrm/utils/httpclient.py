@@ -1,8 +1,11 @@
 import abc
 import logging
+import time
 
 import aiohttp
 
+from . import metrics
+
 
 class BaseClient(abc.ABC):
     SERVICE_BASE: str = ...
@@ -12,12 +15,15 @@ class BaseClient(abc.ABC):
         self.http = http
 
     async def request(self, method: str, route: str, **kwargs):
+        status = 'error'
+        start = time.perf_counter()
         try:
             async with self.http.request(
                     method,
                     f"{self.SERVICE_BASE}{route}",
                     **kwargs
             ) as resp:
+                status = resp.status
                 self.logger.debug(f"{method} {self.SERVICE_BASE}{route} returned {resp.status}")
                 if not 199 < resp.status < 300:
                     data = await resp.text()
@@ -36,7 +42,12 @@ class BaseClient(abc.ABC):
                     raise RuntimeError(f"Could not deserialize response: {data}")
         except aiohttp.ServerTimeoutError:
             self.logger.warning(f"Request timeout: {method} {self.SERVICE_BASE}{route}")
+            status = 'timeout'
             raise RuntimeError("Timed out connecting. Please try again in a few minutes.")
+        finally:
+            metrics.HTTP_REQUEST_LATENCY.observe(
+                time.perf_counter() - start, service=type(self).__name__, method=method, route=route, status=status
+            )
         return data
 
     async def get(self, route: str, **kwargs):
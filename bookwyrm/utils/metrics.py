@@ -0,0 +1,290 @@
+import asyncio
+import bisect
+import functools
+import logging
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Tuple
+
+import disnake
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# ==== metric types ====
+def _escape(value: str) -> str:
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(labels: Iterable[Tuple[str, str]]) -> str:
+    labels = list(labels)
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _format_ms(seconds: float) -> str:
+    if seconds == float('inf'):
+        return '+Inf'
+    return f"{seconds * 1000:.0f}ms"
+
+
+class _Metric:
+    type_name: str = ...
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: Tuple[str, ...]) -> List[Tuple[str, str]]:
+        return list(zip(self.labelnames, key))
+
+    @property
+    def family_name(self) -> str:
+        """The name used in the HELP and TYPE lines, which must match the sample names."""
+        return self.name
+
+    def samples(self) -> List[Tuple[str, List[Tuple[str, str]], float]]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.family_name} {self.documentation}", f"# TYPE {self.family_name} {self.type_name}"]
+        for name, labels, value in self.samples():
+            out.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return out
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    @property
+    def family_name(self) -> str:
+        return f"{self.name}_total"
+
+    def samples(self):
+        return [(self.family_name, self._labels(key), value) for key, value in self.values.items()]
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self, *args, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        # key -> (per-bucket counts, sum, count)
+        self.values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        if key not in self.values:
+            self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        entry = self.values[key]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the wall time spent in the body of the with block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        out = []
+        for key, (counts, total, count) in self.values.items():
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                out.append((f"{self.name}_bucket", labels + [('le', _format_value(bound))], cumulative))
+            out.append((f"{self.name}_sum", labels, total))
+            out.append((f"{self.name}_count", labels, count))
+        return out
+
+    def summary(self, key: Tuple[str, ...]) -> Dict[str, float]:
+        """Returns the count, mean, and an upper bound on the p50/p99 for the given label values."""
+        counts, total, count = self.values[key]
+        out = {'count': count, 'mean': total / count if count else 0.0}
+        for q in (0.5, 0.99):
+            target = q * count
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                if cumulative >= target:
+                    out[f'p{int(q * 100)}'] = bound
+                    break
+        return out
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, _Metric] = {}
+
+    def _register(self, cls, name, *args, **kwargs):
+        if name not in self.metrics:
+            self.metrics[name] = cls(name, *args, **kwargs)
+        return self.metrics[name]
+
+    def counter(self, name: str, documentation: str, labelnames=()) -> Counter:
+        return self._register(Counter, name, documentation, labelnames)
+
+    def histogram(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render(self) -> str:
+        """Renders all metrics in the Prometheus text exposition format."""
+        out = []
+        for metric in self.metrics.values():
+            out.extend(metric.render())
+        return '\n'.join(out) + '\n'
+
+    def snapshot(self) -> str:
+        """A short human-readable summary of all metrics."""
+        out = []
+        for metric in self.metrics.values():
+            if not metric.values:
+                continue
+            out.append(f"{metric.name}:")
+            for key in sorted(metric.values):
+                label_str = ', '.join(f"{k}={v}" for k, v in metric._labels(key)) or '-'
+                if isinstance(metric, Histogram):
+                    s = metric.summary(key)
+                    out.append(
+                        f"  {label_str}: n={s['count']} mean={s['mean'] * 1000:.1f}ms "
+                        f"p50<={_format_ms(s['p50'])} p99<={_format_ms(s['p99'])}"
+                    )
+                else:
+                    out.append(f"  {label_str}: {metric.values[key]:g}")
+        return '\n'.join(out) or "No metrics recorded yet."
+
+
+REGISTRY = Registry()
+
+# ==== bookwyrm metrics ====
+SLASH_COMMAND_LATENCY = REGISTRY.histogram(
+    'bookwyrm_slash_command_seconds', "Time spent running slash commands", ('command',)
+)
+SLASH_COMMAND_ERRORS = REGISTRY.counter(
+    'bookwyrm_slash_command_errors', "Slash command invocations that raised an error", ('command', 'error')
+)
+HTTP_REQUEST_LATENCY = REGISTRY.histogram(
+    'bookwyrm_http_request_seconds', "Time spent on upstream HTTP requests", ('service', 'method', 'route', 'status')
+)
+WEATHER_PROVIDER_LATENCY = REGISTRY.histogram(
+    'bookwyrm_weather_provider_seconds', "Time spent on each weather provider attempt when failing over",
+    ('provider', 'method', 'outcome')
+)
+DB_QUERY_LATENCY = REGISTRY.histogram(
+    'bookwyrm_db_query_seconds', "Time spent executing database statements", ('statement',)
+)
+AUTOCOMPLETE_LATENCY = REGISTRY.histogram(
+    'bookwyrm_autocomplete_seconds', "Time spent generating autocomplete results", ('name',)
+)
+BROADCAST_MESSAGES = REGISTRY.counter(
+    'bookwyrm_broadcast_messages', "Outcomes of scheduled weather deliveries to linked channels", ('status',)
+)
+BROADCAST_TICK_LATENCY = REGISTRY.histogram(
+    'bookwyrm_broadcast_tick_seconds', "Time spent running one tick of the weather broadcast scheduler"
+)
+EVENT_LOOP_LAG = REGISTRY.histogram(
+    'bookwyrm_event_loop_lag_seconds', "How late the event loop wakes up a sleeping task",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+)
+
+
+# ==== slash commands ====
+_inflight_commands: Dict[int, float] = {}
+
+
+def slash_command_name(inter: disnake.ApplicationCommandInteraction) -> str:
+    """Returns the full name of the invoked slash command, including any subcommand groups."""
+    parts = [inter.data.name]
+    options = inter.data.options
+    while options and options[0].type in (disnake.OptionType.sub_command, disnake.OptionType.sub_command_group):
+        parts.append(options[0].name)
+        options = options[0].options
+    return ' '.join(parts)
+
+
+def start_slash_command(inter: disnake.ApplicationCommandInteraction):
+    _inflight_commands[inter.id] = time.perf_counter()
+
+
+def finish_slash_command(inter: disnake.ApplicationCommandInteraction):
+    start = _inflight_commands.pop(inter.id, None)
+    if start is not None:
+        SLASH_COMMAND_LATENCY.observe(time.perf_counter() - start, command=slash_command_name(inter))
+
+
+def record_slash_command_error(inter: disnake.ApplicationCommandInteraction, error: Exception):
+    # the after-invoke hook normally finishes the timer; this catches anything that failed before it ran
+    finish_slash_command(inter)
+    error = getattr(error, 'original', error)
+    SLASH_COMMAND_ERRORS.inc(command=slash_command_name(inter), error=type(error).__name__)
+
+
+# ==== autocomplete ====
+def timed_autocomplete(name: str):
+    """Decorator to record the latency of an autocomplete callback."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with AUTOCOMPLETE_LATENCY.time(name=name):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# ==== event loop ====
+async def monitor_event_loop_lag(interval: float = 0.5):
+    """Sleeps in a loop and records how much later than requested each wakeup happens."""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(loop.time() - start - interval, 0))
+
+
+# ==== export ====
+async def _handle_metrics(_: web.Request) -> web.Response:
+    return web.Response(text=REGISTRY.render(), content_type='text/plain', charset='utf-8')
+
+
+async def serve(host: str, port: int) -> web.AppRunner:
+    """Starts an HTTP server exposing the metrics in the Prometheus text format at /metrics."""
+    app = web.Application()
+    app.router.add_get('/metrics', _handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
@@ -4,6 +4,7 @@ import disnake
 from disnake.ext import commands
 
 from bookwyrm import config, db
+from bookwyrm.utils import metrics
 
 COGS = ('bookwyrm.cogs.weather', 'bookwyrm.cogs.admin')
 
@@ -36,6 +37,7 @@ async def on_ready():
 
 @bot.event
 async def on_slash_command_error(inter, error):
+    metrics.record_slash_command_error(inter, error)
     await inter.send(f"Error: {error!s}", ephemeral=True)
 
 
@@ -50,4 +52,7 @@ for cog in COGS:
 
 if __name__ == '__main__':
     bot.loop.create_task(db.init_db())
+    bot.loop.create_task(metrics.monitor_event_loop_lag())
+    if config.METRICS_PORT:
+        bot.loop.create_task(metrics.serve(config.METRICS_HOST, int(config.METRICS_PORT)))
     bot.run(config.TOKEN)